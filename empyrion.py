@@ -9,18 +9,32 @@ Also implements reading from STL files, and performing the point refinement.
 
 import os
 import sys
+import zlib
 import math
+import mmap
 import time
+import shutil
 import struct
+import tempfile
+import itertools
 import StringIO
 import zipfile
 import multiprocessing
 from copy import copy
+from collections import OrderedDict
 
 # Maximum number of points to attempt to generate per process, for memory bounding
 # purposes.
 MAX_POINTS_PER_PROCESS = 2000.0
 
+# Smallest edge length, in voxels, of the tiles that morphological closing is
+# performed in. Each tile also holds a margin of the sum of the closing radii, so
+# the tiles grow with the radii to keep the margins from dominating: on a sphere
+# shell of radius 30, closing with radii of 6 took 96 seconds in tiles of 16, 28
+# seconds in tiles of 48 and 24 seconds without tiles, and with radii of 4, 14, 7
+# and 6 seconds in tiles of 16, 32 and none.
+CLOSING_TILE_SIZE = 16
+
 # Build the list of unit vetors
 UNIT_VECTORS = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0,-1)]
 # Valid slopes, expressed as 1/m = the number of blocks required to complete the slope.
@@ -33,10 +47,54 @@ TUPLE_MUL = lambda t1, t2: (t1[0] * t2[0], t1[1] * t2[1], t1[2] * t2[2])
 TUPLE_LE = lambda t1, t2: (t1[0] < t2[0]) and (t1[1] < t2[1]) and (t1[2] < t2[2])
 TI = lambda a, t: a[t[0]][t[1]][t[2]]
 TUPLE_SCALE = lambda a, t: (a * t[0], a * t[1], a * t[2])
+# The order the blocks are laid out in a blueprint, by third, second, then first
+# coordinate. Smoothing and corner filling visit points in this order, so that their
+# result does not depend on the order the points are given in.
+BLUEPRINT_ORDER = lambda t: (t[2], t[1], t[0])
 
 SIGN_S = lambda s: -1 if s < 0 else 1 if s > 0 else 0
 SIGN_V = lambda v: tuple([SIGN_S(c) for c in v])
 
+# The opposite of each unit vector, pairing the down vector of a slope with its up
+# vector.
+OPPOSITE_VECTORS = dict([(v, TUPLE_SCALE(-1, v)) for v in UNIT_VECTORS])
+# The unit vectors perpendicular to each unit vector, in the order of UNIT_VECTORS.
+PERPENDICULAR_VECTORS = dict([
+    (f, [v for v in UNIT_VECTORS if TUPLE_DOT(v, f) == 0]) for f in UNIT_VECTORS
+])
+# The unit vectors perpendicular to a forward vector, other than a given down vector.
+PERPENDICULAR_EXCLUDING = dict([
+    ((f, d), [v for v in PERPENDICULAR_VECTORS[f] if v != d])
+    for f in UNIT_VECTORS for d in PERPENDICULAR_VECTORS[f]
+])
+
+# Each of the 26 neighbours of a voxel is given one bit of a neighbourhood mask.
+NEIGHBOUR_OFFSETS = [(i, j, k)
+                     for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+                     if (i, j, k) != (0, 0, 0)]
+NEIGHBOUR_BITS = dict([(o, 1 << n) for n, o in enumerate(NEIGHBOUR_OFFSETS)])
+# The neighbours that share an edge with a voxel. A slope in the forward direction
+# from a voxel rests on one of these, and corners are found between these.
+EDGE_OFFSETS = [o for o in NEIGHBOUR_OFFSETS if abs(o[0]) + abs(o[1]) + abs(o[2]) == 2]
+
+
+def adjacency_table(forward):
+    """
+    Given a forward vector, build the mask of the neighbourhood bits that a slope
+    in that direction can rest on, and a table mapping every combination of those
+    bits to the candidate (down, up) vector pairs for the slope.
+    """
+    bits = [NEIGHBOUR_BITS[TUPLE_ADD(forward, v)] for v in PERPENDICULAR_VECTORS[forward]]
+    table = dict()
+    for n in range(1 << len(bits)):
+        mask = sum([b for i, b in enumerate(bits) if n & (1 << i)])
+        table[mask] = [(v, OPPOSITE_VECTORS[v])
+                       for v, b in zip(PERPENDICULAR_VECTORS[forward], bits) if mask & b]
+    return (sum(bits), table)
+
+
+ADJACENCY_TABLES = dict([(f, adjacency_table(f)) for f in UNIT_VECTORS])
+
 def leq(a, b):
     """
     Given two values, return a boolean or None, depending on whether a < b, 
@@ -109,6 +167,100 @@ class Triple(object):
             return Triple(*TUPLE_MUL((self.x, self.y, self.x), scalar))
 
 
+class AxisTransform(object):
+    """
+    An affine transform made of a shift, a permutation of the axes, and reflections
+    in any of the axes. A point p is mapped to p' with
+    p'[i] = scale[i] * (p[perm[i]] + shift[perm[i]]), where each scale is 1 or -1.
+    """
+
+    def __init__(self, shift=(0, 0, 0), perm=(0, 1, 2), scale=(1, 1, 1)):
+        self.shift = tuple(shift)
+        self.perm = tuple(perm)
+        self.scale = tuple(scale)
+
+    def __str__(self):
+        return "<shift=%s,perm=%s,scale=%s>" % (str(self.shift), str(self.perm),
+                                                 str(self.scale))
+
+    def __repr__(self):
+        return str(self)
+
+    @staticmethod
+    def from_options(dim_remap=(1, 2, 3), dim_mirror=(), shift=(0, 0, 0)):
+        """
+        Build the transform that shifts the model, then remaps the dimensions with a
+        permutation of 1, 2, 3, and then mirrors the listed (remapped) dimensions.
+        """
+        return AxisTransform(
+            shift,
+            [d - 1 for d in dim_remap],
+            [-1 if i + 1 in dim_mirror else 1 for i in range(3)])
+
+    def dimension(self, dim):
+        """
+        Given a dimension (1, 2 or 3) before the transform, return the dimension it is
+        moved to.
+        """
+        return self.perm.index(dim - 1) + 1
+
+    def points(self, pts):
+        """
+        Transform a list of points, which can be tuples or Triples.
+        """
+        (a, b, c) = self.perm
+        (sa, sb, sc) = self.scale
+        (ha, hb, hc) = (self.shift[a], self.shift[b], self.shift[c])
+        if (ha, hb, hc) == (0, 0, 0):
+            return [(sa * p[a], sb * p[b], sc * p[c]) for p in pts]
+        return [(sa * (p[a] + ha), sb * (p[b] + hb), sc * (p[c] + hc)) for p in pts]
+
+    def triangles(self, tris):
+        """
+        Transform a list of triangles, returning new Triples of Triples. Vertices
+        shared between triangles, as in IndexedMesh.triangles(), are transformed once
+        and remain shared.
+        """
+        (a, b, c) = self.perm
+        (sa, sb, sc) = self.scale
+        (ha, hb, hc) = (self.shift[a], self.shift[b], self.shift[c])
+        transformed = dict()
+
+        def vertex(v):
+            t = transformed.get(id(v))
+            if t is None:
+                t = Triple(sa * (v[a] + ha), sb * (v[b] + hb), sc * (v[c] + hc))
+                transformed[id(v)] = t
+            return t
+        return [Triple(vertex(t.x), vertex(t.y), vertex(t.z)) for t in tris]
+
+    def is_rotation(self):
+        """
+        Return whether the transform is a rotation, rather than a mirror image of the
+        model, which is when the permutation parity and the reflections cancel.
+        """
+        sign = self.scale[0] * self.scale[1] * self.scale[2]
+        for i in range(3):
+            for j in range(i + 1, 3):
+                if self.perm[i] > self.perm[j]:
+                    sign = -sign
+        return sign > 0
+
+    @staticmethod
+    def orientations():
+        """
+        Return the (dim_remap, dim_mirror) options of all 48 orientations of a model
+        that keep it aligned to the axes: the 6 permutations of the dimensions with
+        each of the 8 combinations of mirrored dimensions.
+        """
+        options = []
+        for dim_remap in itertools.permutations((1, 2, 3)):
+            for mask in range(8):
+                dim_mirror = tuple(d for d in (1, 2, 3) if mask & (1 << (d - 1)))
+                options.append((dim_remap, dim_mirror))
+        return options
+
+
 class STLFile(object):
     """
     Represents basic knowledge of the STL file format.
@@ -212,6 +364,242 @@ class STLFile(object):
         return (name, triangles)
 
 
+def compression_wbits(data):
+    """
+    Given the start of some data, return the zlib wbits value that decompresses it if
+    it is gzip or zlib (HTTP deflate) compressed, recognised by its magic bytes, or
+    None if it is not compressed. Since a binary STL header can be anything, the
+    zlib magic is only trusted if the first bytes also decompress.
+    """
+    if data[:2] == '\x1f\x8b':
+        return 16 + zlib.MAX_WBITS
+    if (len(data) >= 2 and ord(data[0]) & 0x0f == 8 and ord(data[0]) >> 4 <= 7 and
+            not ord(data[1]) & 0x20 and (ord(data[0]) * 256 + ord(data[1])) % 31 == 0):
+        try:
+            zlib.decompressobj(zlib.MAX_WBITS).decompress(data[:64])
+            return zlib.MAX_WBITS
+        except zlib.error:
+            pass
+    return None
+
+
+class InflatingReader(object):
+    """
+    A read-only file object that decompresses a gzip or zlib stream as it is read,
+    so that the STL parser is fed directly, and the whole of the decompressed file is
+    never held in memory. Supports the read(), readline() and seek(0) calls made by
+    STLFile.
+    """
+    CHUNK_SIZE = 2**14
+
+    def __init__(self, file_descriptor, wbits):
+        self.file_descriptor = file_descriptor
+        self.wbits = wbits
+        self.seek(0)
+
+    def seek(self, offset):
+        if offset != 0:
+            raise ValueError("A compressed stream can only be rewound to the start.")
+        self.file_descriptor.seek(0)
+        self.inflater = zlib.decompressobj(self.wbits)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Decompress another chunk onto the buffer, dropping the part already read.
+        """
+        chunk = self.file_descriptor.read(self.CHUNK_SIZE)
+        if chunk:
+            data = self.inflater.decompress(chunk)
+        else:
+            data = self.inflater.flush()
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+            self._fill()
+        end = len(self.buffer) if size < 0 else self.pos + size
+        data = self.buffer[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        start = self.pos
+        end = self.buffer.find('\n', start)
+        while end < 0 and not self.eof:
+            searched = len(self.buffer) - self.pos
+            self._fill()
+            start = 0
+            end = self.buffer.find('\n', searched)
+        end = len(self.buffer) if end < 0 else end + 1
+        data = self.buffer[start:end]
+        self.pos = end
+        return data
+
+
+class IndexedMesh(object):
+    """
+    A triangle mesh stored as a list of distinct vertices, and a list of faces that
+    each hold the indices of their three vertices.
+    """
+
+    def __init__(self, vertices, faces):
+        self.vertices = vertices
+        self.faces = faces
+
+    def __len__(self):
+        return len(self.faces)
+
+    @staticmethod
+    def weld(tris, tolerance=0.0):
+        """
+        Build an indexed mesh from a list of triangles, welding together vertices
+        that are within tolerance of each other in every dimension, using a spatial
+        hash with cells of the tolerance in size. Faces that collapse to a line or a
+        point, have zero area, or repeat another face, are dropped. Returns the mesh
+        and a dict counting what was merged and removed.
+        """
+        vertices = []
+        exact = dict()
+        grid = dict()
+        cell = lambda p: tuple([int(math.floor(c / tolerance)) for c in p])
+
+        def index(v):
+            p = (v[0], v[1], v[2])
+            i = exact.get(p)
+            if i is not None:
+                return i
+            if tolerance > 0:
+                (cx, cy, cz) = cell(p)
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for dz in (-1, 0, 1):
+                            for j in grid.get((cx + dx, cy + dy, cz + dz), ()):
+                                w = vertices[j]
+                                if (abs(w[0] - p[0]) <= tolerance and
+                                        abs(w[1] - p[1]) <= tolerance and
+                                        abs(w[2] - p[2]) <= tolerance):
+                                    exact[p] = j
+                                    return j
+                grid.setdefault((cx, cy, cz), []).append(len(vertices))
+            exact[p] = len(vertices)
+            vertices.append(p)
+            return exact[p]
+
+        report = {'vertices_in': 3 * len(tris), 'collapsed': 0, 'degenerate': 0,
+                  'duplicate': 0}
+        faces = []
+        seen = set()
+        for t in tris:
+            f = (index(t.x), index(t.y), index(t.z))
+            if f[0] == f[1] or f[1] == f[2] or f[0] == f[2]:
+                report['collapsed'] += 1
+                continue
+            (a, b, c) = [vertices[i] for i in f]
+            u = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+            v = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+            n = (u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2],
+                 u[0] * v[1] - u[1] * v[0])
+            if n[0] == 0 and n[1] == 0 and n[2] == 0:
+                report['degenerate'] += 1
+                continue
+            key = tuple(sorted(f))
+            if key in seen:
+                report['duplicate'] += 1
+                continue
+            seen.add(key)
+            faces.append(f)
+
+        report['vertices'] = len(vertices)
+        return IndexedMesh([Triple(*p) for p in vertices], faces), report
+
+    def triangles(self):
+        """
+        Return the faces as a list of Triples of vertex Triples, where faces that
+        share a vertex share the same Triple object.
+        """
+        v = self.vertices
+        return [Triple(v[i], v[j], v[k]) for (i, j, k) in self.faces]
+
+    def cluster(self, cell_size):
+        """
+        Decimate the mesh by vertex clustering: every vertex is replaced by the mean
+        of all vertices in the same cubic cell of the given size, and the faces that
+        collapse, or come to repeat another face, are dropped. Returns the decimated
+        mesh and a dict counting what was merged and removed.
+        """
+        clusters = dict()
+        members = []
+        for v in self.vertices:
+            c = (int(math.floor(v[0] / cell_size)), int(math.floor(v[1] / cell_size)),
+                 int(math.floor(v[2] / cell_size)))
+            members.append(clusters.setdefault(c, len(clusters)))
+
+        sums = [[0.0, 0.0, 0.0, 0] for _ in xrange(len(clusters))]
+        for v, i in zip(self.vertices, members):
+            s = sums[i]
+            s[0] += v[0]
+            s[1] += v[1]
+            s[2] += v[2]
+            s[3] += 1
+        vertices = [Triple(s[0] / s[3], s[1] / s[3], s[2] / s[3]) for s in sums]
+
+        report = {'vertices_in': len(self.vertices), 'vertices': len(vertices),
+                  'faces_in': len(self.faces), 'collapsed': 0, 'duplicate': 0}
+        faces = []
+        seen = set()
+        for (i, j, k) in self.faces:
+            f = (members[i], members[j], members[k])
+            if f[0] == f[1] or f[1] == f[2] or f[0] == f[2]:
+                report['collapsed'] += 1
+                continue
+            key = tuple(sorted(f))
+            if key in seen:
+                report['duplicate'] += 1
+                continue
+            seen.add(key)
+            faces.append(f)
+        return IndexedMesh(vertices, faces), report
+
+
+def voxel_set_distance(a, b, limit=3):
+    """
+    Compare the voxel set a with the voxel set b, returning the number of voxels of a
+    that are not in b, and the largest distance (in blocks, along any one axis) from
+    one of them to the nearest voxel of b. Distances beyond the limit are not searched
+    for, and are reported as limit + 1.
+    """
+    b = point_set(b)
+    only_a = [p for p in point_set(a) if p not in b]
+    shells = [[(x, y, z)
+               for x in xrange(-r, r + 1) for y in xrange(-r, r + 1)
+               for z in xrange(-r, r + 1) if max(abs(x), abs(y), abs(z)) == r]
+              for r in xrange(1, limit + 1)]
+
+    distance = 0
+    for p in only_a:
+        for r, shell in enumerate(shells, 1):
+            if any(TUPLE_ADD(p, o) in b for o in shell):
+                distance = max(distance, r)
+                break
+        else:
+            return len(only_a), limit + 1
+    return len(only_a), distance
+
+
+def mesh_weld_tolerance(tris, relative=1e-6):
+    """
+    Return a vertex welding tolerance for a list of triangles, as a fraction of the
+    length of the diagonal of their bounding box.
+    """
+    bounds = triangle_list_bounds(tris)
+    return relative * math.sqrt(sum([(b[1] - b[0]) ** 2 for b in bounds]))
+
+
 def triangle_list_bounds(tris):
     """
     Given a list of triangles, find the minimum and maximum bounds in each
@@ -250,6 +638,35 @@ def max_edge_norm(Tri):
         l2_norm(vsub(Tri.y, Tri.z)), l2_norm(vsub(Tri.x, Tri.z)))
 
 
+def triangle_area(Tri):
+    """
+    Given a triangle, find its area.
+    """
+    u = vsub(Tri.y, Tri.x)
+    v = vsub(Tri.z, Tri.x)
+    return 0.5 * l2_norm(Triple(u.y * v.z - u.z * v.y, u.z * v.x - u.x * v.z,
+                                u.x * v.y - u.y * v.x))
+
+
+def mesh_statistics(tris, Resolution):
+    """
+    Given a list of triangles and a spatial resolution, return the total surface
+    area in square voxels, and the shortest, mean and longest edge lengths in voxels.
+    """
+    area = 0.0
+    edges = []
+    for tri in tris:
+        area += triangle_area(tri)
+        edges += [l2_norm(vsub(tri.x, tri.y)), l2_norm(vsub(tri.y, tri.z)),
+                  l2_norm(vsub(tri.x, tri.z))]
+    return {
+        'area': area / Resolution ** 2,
+        'edge_min': min(edges) / Resolution,
+        'edge_mean': sum(edges) / len(edges) / Resolution,
+        'edge_max': max(edges) / Resolution
+    }
+
+
 def mean(v):
     """
     Find the mean of all elements of a triple.
@@ -304,6 +721,263 @@ def rescale_round_point(Point, Resolution):
             int(round(Point.z / Resolution)))
 
 
+def small_tri_voxels(Tri, Resolution):
+    """
+    Given a triangle and a spatial resolution, return the voxels its vertices round
+    to if those voxels span a box of at most two voxels, or None otherwise. Every
+    point produced by splitting the triangle lies within that box, and so rounds to
+    one of the vertex voxels, so small triangles need not be split at all.
+    """
+    a = rescale_round_point(Tri.x, Resolution)
+    b = rescale_round_point(Tri.y, Resolution)
+    c = rescale_round_point(Tri.z, Resolution)
+    volume = 1
+    for i in range(3):
+        volume *= max(a[i], b[i], c[i]) - min(a[i], b[i], c[i]) + 1
+        if volume > 2:
+            return None
+    return (a, b, c)
+
+
+def split_tri_vertices(Tri, Resolution, midpoints):
+    """
+    Hexsect a triangle exactly as split_tri does, but return the vertices of the
+    resulting triangles, as tuples, rather than the triangles. Every vertex is a
+    corner of the triangle or was created by one of the hexsections, so each is
+    returned once, instead of once for every subtriangle it is shared by.
+
+    Edge midpoints are looked up in, and added to, the given dict keyed by the
+    endpoints of the edge. Edges shared with triangles split earlier using the same
+    dict are not split again, and their midpoints are not returned again.
+    """
+    sqrt = math.sqrt
+    corners = tuple([(Tri[i][0], Tri[i][1], Tri[i][2]) for i in range(3)])
+    vertices = list(corners)
+    large = [corners]
+    while len(large) > 0:
+        next_large = []
+        for (p, q, r) in large:
+            centroid = ((p[0] + q[0] + r[0]) / 3.0, (p[1] + q[1] + r[1]) / 3.0,
+                        (p[2] + q[2] + r[2]) / 3.0)
+            vertices.append(centroid)
+            mids = []
+            for (u, v) in ((p, q), (p, r), (q, r)):
+                key = (u, v) if u < v else (v, u)
+                m = midpoints.get(key)
+                if m is None:
+                    m = ((u[0] + v[0]) / 2.0, (u[1] + v[1]) / 2.0,
+                         (u[2] + v[2]) / 2.0)
+                    midpoints[key] = m
+                    vertices.append(m)
+                mids.append(m)
+            (m1, m2, m3) = mids
+            for t in ((p, m1, centroid), (m1, q, centroid), (p, m2, centroid),
+                      (m2, r, centroid), (q, m3, centroid), (m3, r, centroid)):
+                # The same edge test as max_edge_norm
+                for (u, v) in ((t[0], t[1]), (t[1], t[2]), (t[0], t[2])):
+                    d0 = u[0] - v[0]
+                    d1 = u[1] - v[1]
+                    d2 = u[2] - v[2]
+                    if sqrt(d0 * d0 + d1 * d1 + d2 * d2) > Resolution:
+                        next_large.append(t)
+                        break
+        large = next_large
+    return vertices
+
+
+def round_vertices(vertices, Resolution):
+    """
+    Round a list of vertex tuples to the nearest lattice points, as
+    rescale_round_point does.
+    """
+    return [(int(round(v[0] / Resolution)), int(round(v[1] / Resolution)),
+             int(round(v[2] / Resolution))) for v in vertices]
+
+
+def tri_voxels(Tri, Resolution, midpoints=None):
+    """
+    Return the list of voxels that a triangle is split into, taking the fast path
+    for triangles that cover at most two voxels. A dict of edge midpoints may be
+    shared between calls for neighbouring triangles, as in split_tri_vertices.
+    """
+    small = small_tri_voxels(Tri, Resolution)
+    if small is not None:
+        return small
+    if midpoints is None:
+        midpoints = dict()
+    return round_vertices(split_tri_vertices(Tri, Resolution, midpoints), Resolution)
+
+
+def column_crossings(Primitives, Resolution):
+    """
+    Cast a ray in the z direction through the centre of every (x, y) column of
+    voxels, and return a dict that maps each column to the sorted list of heights,
+    in voxel units, at which the ray crosses a triangle. The rays are nudged off the
+    voxel centres by a tiny amount, so that they do not pass exactly through the
+    shared edges and vertices of a mesh built on a grid.
+    """
+    nudge = (1.1e-7, 1.7e-7)
+    columns = dict()
+    for tri in Primitives:
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = [
+            [tri[i][d] / Resolution for d in range(3)] for i in range(3)]
+        area = (bx - ax) * (cy - ay) - (cx - ax) * (by - ay)
+        if area == 0:
+            # Triangles seen edge-on from above are never crossed.
+            continue
+        for i in xrange(int(math.ceil(min(ax, bx, cx) - nudge[0])),
+                        int(math.floor(max(ax, bx, cx) - nudge[0])) + 1):
+            x = i + nudge[0]
+            for j in xrange(int(math.ceil(min(ay, by, cy) - nudge[1])),
+                            int(math.floor(max(ay, by, cy) - nudge[1])) + 1):
+                y = j + nudge[1]
+                # Barycentric weights of the ray within the projected triangle
+                u = ((bx - x) * (cy - y) - (cx - x) * (by - y)) / area
+                v = ((cx - x) * (ay - y) - (ax - x) * (cy - y)) / area
+                w = 1.0 - u - v
+                if u < 0 or v < 0 or w < 0:
+                    continue
+                columns.setdefault((i, j), []).append(u * az + v * bz + w * cz)
+    for crossings in columns.itervalues():
+        crossings.sort()
+    return columns
+
+
+def solid_fill(Primitives, Resolution):
+    """
+    Given the triangles of a closed mesh, return the set of voxels whose centres lie
+    inside it, by pairing up the crossings of a ray through each column of voxels:
+    the ray is inside the mesh between the first and second crossing, the third and
+    fourth, and so on. Columns with an odd number of crossings, where the mesh is not
+    closed, have their last crossing ignored.
+    """
+    pts = set()
+    odd_columns = 0
+    for (i, j), crossings in column_crossings(Primitives, Resolution).iteritems():
+        if len(crossings) % 2 == 1:
+            odd_columns += 1
+        for n in xrange(0, len(crossings) - 1, 2):
+            for k in xrange(int(math.ceil(crossings[n])),
+                            int(math.floor(crossings[n + 1])) + 1):
+                pts.add((i, j, k))
+    if odd_columns > 0:
+        sys.stderr.write("Warning: %d columns crossed the mesh an odd number of times; "
+                         "the mesh may not be closed.\n" % odd_columns)
+    return pts
+
+
+class PipeQueue(object):
+    """
+    A stand-in for multiprocessing.Queue() for a single worker process, built on a
+    pipe. Unlike a Queue it needs no POSIX semaphores, so works where /dev/shm is
+    missing, as on AWS Lambda. The pipe is only opened, with open(), just before the
+    process is started, so that queued processes do not hold file descriptors.
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+
+    def open(self):
+        self.reader, self.writer = multiprocessing.Pipe(False)
+
+    def put(self, obj):
+        self.writer.send(obj)
+
+    def get(self):
+        return self.reader.recv()
+
+    def empty(self):
+        return not self.reader.poll()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+def output_queues(n):
+    """
+    Return the output queues for n worker processes, one for each. Where /dev/shm is
+    available, the processes share one multiprocessing Queue. Elsewhere each has its
+    own PipeQueue, since several processes cannot safely write to one pipe.
+    """
+    if shared_memory():
+        return [multiprocessing.Queue()] * n
+    return [PipeQueue() for _ in range(n)]
+
+
+def start_process(proc, queue):
+    """
+    Start a worker process, opening its output queue first if that is a pipe.
+    """
+    if isinstance(queue, PipeQueue):
+        queue.open()
+    proc.start()
+
+
+def drain_queues(running, consume):
+    """
+    Given (process, output queue) pairs for started processes, pass every result
+    waiting on the queues to the consume function, and return the pairs of the
+    processes still running. A process writing to a pipe cannot exit until its
+    result is read, so only the processes that had exited before the queues were
+    drained are finished, and their pipes are closed.
+    """
+    alive = [p.is_alive() for p, _ in running]
+    for q in dict((id(q), q) for _, q in running).itervalues():
+        while not q.empty():
+            consume(q.get())
+    for (_, q), a in zip(running, alive):
+        if not a and isinstance(q, PipeQueue):
+            q.close()
+    return [r for r, a in zip(running, alive) if a]
+
+
+def run_process_pool(procs, queues, consume):
+    """
+    Run the given Process() objects, at most cpu_count() at a time, passing every
+    result put on their output queues (from output_queues()) to the consume
+    function as it arrives.
+    """
+    finished_procs = [0]
+
+    def report(pipe_pts):
+        finished_procs[0] += 1
+        sys.stderr.write("%d (%d/%d) " %
+                         (len(pipe_pts), finished_procs[0], len(procs)))
+        consume(pipe_pts)
+
+    # First, start cpu_count() processes.
+    queued = zip(procs, queues)
+    running = queued[:multiprocessing.cpu_count()]
+    queued = queued[len(running):]
+    for p, q in running:
+        start_process(p, q)
+
+    # As long as there's a running process, keep cycling.
+    while len(running) > 0:
+        # Attempt to join all running processes.
+        for p, _ in running:
+            p.join(0.0)
+
+        # Read the results, and rebuild the running processes list to only include
+        # those still alive.
+        running = drain_queues(running, report)
+
+        # If there are fewer running processes than available CPUs, start some more.
+        pending = queued[:multiprocessing.cpu_count() - len(running)]
+        queued = queued[len(pending):]
+        for p, q in pending:
+            start_process(p, q)
+        running += pending
+
+        # Give the processes another second to do some work before checking on them.
+        # Prevents a certain amount of busywaiting.
+        time.sleep(1.0)
+
+    sys.stderr.write("\n")
+
+
 def parallel_split_tris(Primitives, Resolution, BatchSize=100):
     """
     Perform the split_tris() operation on chunks of primitives in parallel, and
@@ -333,61 +1007,18 @@ def parallel_split_tris(Primitives, Resolution, BatchSize=100):
         Primitives[i:i + prims_per_process]
         for i in xrange(0, len(Primitives), prims_per_process)
     ]
-    output_queue = multiprocessing.Queue()
+    queues = output_queues(len(primitive_chunks))
     procs = [
         multiprocessing.Process(
             target=split_tris,
-            args=(chunk, Resolution, BatchSize, output_queue))
-        for chunk in primitive_chunks
+            args=(chunk, Resolution, BatchSize, q))
+        for chunk, q in zip(primitive_chunks, queues)
     ]
     sys.stderr.write("Prepared %d processes of work\n" % len(procs))
 
-    # First, start cpu_count() processes.
-    running_procs = procs[:multiprocessing.cpu_count()]
-    for p in running_procs:
-        p.start()
-    queued_procs = [p for p in procs if p not in running_procs]
-    finished_procs = 0
-
     pts = set()
-    # As long as there's a running process, keep cycling.
-    while len(running_procs) > 0:
-        # Attempt to join all running processes.
-        for p in running_procs:
-            p.join(0.0)
-
-        while not output_queue.empty():
-            pipe_pts = output_queue.get()
-            finished_procs += 1
-            sys.stderr.write("%d (%d/%d) " %
-                             (len(pipe_pts), finished_procs, len(procs)))
-            pts.update(pipe_pts)
-
-        # Rebuild the running processes list to only include those still alive
-        running_procs = [p for p in running_procs if p.is_alive()]
-
-        # If there are fewer running processes than available CPUs, start some more.
-        pending_procs = queued_procs[:multiprocessing.cpu_count() - len(
-            running_procs)]
-        for p in pending_procs:
-            p.start()
-        # Once started, add them to the pending procs, and remove them from the
-        # list of queued processes.
-        running_procs += pending_procs
-        queued_procs = [p for p in queued_procs if p not in running_procs]
-
-        # Give the processes another second to do some work before checking on them.
-        # Prevents a certain amount of busywaiting.
-        time.sleep(1.0)
-
-    while not output_queue.empty():
-        pts.update(output_queue.get())
-        finished_procs += 1
-        sys.stderr.write("%d (%d/%d) " %
-                         (len(pipe_pts), finished_procs, len(procs)))
-    sys.stderr.write("\n")
-
-    return list(pts)
+    run_process_pool(procs, queues, pts.update)
+    return pts
 
 
 def split_tris(Primitives, Resolution, BatchSize=100, OutputQueue=None):
@@ -403,10 +1034,19 @@ def split_tris(Primitives, Resolution, BatchSize=100, OutputQueue=None):
     start_time = time.time()
     last_print_time = time.time()
     pts = set()
-    tris = []
+    vertices = []
+    # Midpoints of the edges split in this batch, so that edges shared between
+    # neighbouring triangles are only split, and rounded, once.
+    midpoints = dict()
     tris_handled = 0
     for p in Primitives:
-        tris.extend(split_tri(p, Resolution))
+        # Triangles covering at most two voxels are rounded directly, and only the
+        # larger ones are split.
+        small = small_tri_voxels(p, Resolution)
+        if small is not None:
+            pts.update(small)
+        else:
+            vertices.extend(split_tri_vertices(p, Resolution, midpoints))
         # For memory efficiency, perform batch-frequency flatten/union operations, to keep
         # the list of points at any given point in time bounded and reasonable.
         tris_handled += 1
@@ -421,26 +1061,162 @@ def split_tris(Primitives, Resolution, BatchSize=100, OutputQueue=None):
                 )
             )
             # sys.stderr.write("Batch done (%d)\n" % tris_handled)
-            pts.update([
-                rescale_round_point(t[i], Resolution)
-                for i in range(3) for t in tris
-            ])
-            tris = []
+            pts.update(round_vertices(vertices, Resolution))
+            vertices = []
+            midpoints.clear()
 
     # sys.stderr.write("Final round (%d)\n" % tris_handled)
     # One final round of flatten/union
-    pts.update([
-        rescale_round_point(t[i], Resolution) for i in range(3) for t in tris
-    ])
-    pts_l = list(pts)
+    pts.update(round_vertices(vertices, Resolution))
 
     # LEGACY: Super slow on pypy (2x CPython), included for posterity and entertainment.
     #pts = list(set([ rescale_round_point(t[i], Resolution) for i in range(3) for t in tris ]))
+    if OutputQueue is not None:
+        OutputQueue.put(pts)
+    return pts
+
+
+def triangle_voxel_bounds(Tri, Resolution):
+    """
+    Given a triangle and a spatial resolution, return the minimal and maximal voxel
+    coordinates that any point produced by splitting the triangle can round to.
+    """
+    return (
+        tuple([int(round(min(Tri.x[i], Tri.y[i], Tri.z[i]) / Resolution)) for i in range(3)]),
+        tuple([int(round(max(Tri.x[i], Tri.y[i], Tri.z[i]) / Resolution)) for i in range(3)])
+    )
+
+
+def bin_tris_to_tiles(Primitives, Resolution, TileSize):
+    """
+    Bin triangles into cubic tiles of TileSize voxels on a side, returning a dict
+    that maps each tile index to the list of triangles whose voxel-space bounding
+    box overlaps that tile. Triangles spanning a tile boundary are placed in every
+    tile they overlap.
+    """
+    tiles = dict()
+    for tri in Primitives:
+        vmin, vmax = triangle_voxel_bounds(tri, Resolution)
+        tmin = [vmin[i] // TileSize for i in range(3)]
+        tmax = [vmax[i] // TileSize for i in range(3)]
+        for i in xrange(tmin[0], tmax[0] + 1):
+            for j in xrange(tmin[1], tmax[1] + 1):
+                for k in xrange(tmin[2], tmax[2] + 1):
+                    tiles.setdefault((i, j, k), []).append(tri)
+    return tiles
+
+
+def sample_triangles(Primitives, Resolution, TileSize, fraction):
+    """
+    Pick a sample of the triangles with about the given fraction of the surface area,
+    for estimating the work on the whole model from a part of it. The triangles are
+    binned into tiles, and the triangles of evenly spaced tiles are taken, so that the
+    sample is made of patches of neighbouring triangles, which share their edges as
+    they do in the whole model. Return the sampled triangles, and the fraction of the
+    surface area that they cover.
+    """
+    tiles = bin_tris_to_tiles(Primitives, Resolution, TileSize)
+    total_area = sum([triangle_area(tri) for tri in Primitives])
+    if total_area == 0:
+        return Primitives, 1.0
+
+    keys = sorted(tiles.keys())
+    step = max(1, int(round(1.0 / fraction)))
+    keys = [k for offset in range(step) for k in keys[(step // 2 + offset) % step::step]]
+    sampled = OrderedDict()
+    sampled_area = 0.0
+    for k in keys:
+        for tri in tiles[k]:
+            if id(tri) not in sampled:
+                sampled[id(tri)] = tri
+                sampled_area += triangle_area(tri)
+        if sampled_area >= fraction * total_area:
+            break
+    return sampled.values(), sampled_area / total_area
+
+
+def approximate_size(container):
+    """
+    Return the approximate number of bytes used by a set or list of points, or a
+    dict of points to blocks, including the point tuples and their coordinates.
+    """
+    size = sys.getsizeof(container)
+    for p in container:
+        # Python shares a single object for each small integer.
+        size += sys.getsizeof(p) + sum([sys.getsizeof(c) for c in p
+                                        if not -5 <= c <= 256])
+    return size
+
+
+def mesh_size(tris):
+    """
+    Return the approximate number of bytes used by a list of triangles, counting the
+    vertices shared between triangles once.
+    """
+    size = sys.getsizeof(tris)
+    vertices = dict()
+    for tri in tris:
+        size += sys.getsizeof(tri) + sys.getsizeof(tri.__dict__)
+        for v in (tri.x, tri.y, tri.z):
+            vertices[id(v)] = v
+    for v in vertices.itervalues():
+        size += (sys.getsizeof(v) + sys.getsizeof(v.__dict__) +
+                 sys.getsizeof(v.x) + sys.getsizeof(v.y) + sys.getsizeof(v.z))
+    return size
+
+
+def split_tris_tile(Primitives, Resolution, Tile, TileSize, OutputQueue=None):
+    """
+    Split the triangles that overlap a single tile, and keep only the points that
+    fall inside that tile. Since every tile keeps only its own points, the outputs
+    of all tiles are disjoint and can be concatenated without deduplication.
+    """
+    pts = set()
+    midpoints = dict()
+    for p in Primitives:
+        pts.update(tri_voxels(p, Resolution, midpoints))
+    pts_l = [
+        p for p in pts
+        if (p[0] // TileSize, p[1] // TileSize, p[2] // TileSize) == Tile
+    ]
     if OutputQueue is not None:
         OutputQueue.put(pts_l)
     return pts_l
 
 
+def parallel_tiled_split_tris(Primitives, Resolution, TileSize=None):
+    """
+    Perform the split_tris() operation by binning the triangles into spatial tiles
+    in voxel space, and handing whole tiles to each process. Each process returns
+    an already deduplicated set of points that is disjoint from every other tile,
+    so the results are concatenated instead of unioned.
+    """
+    if TileSize is None:
+        # Choose a tile size so that there are several tiles per CPU along the
+        # longest dimension of the model.
+        size = [i[1] - i[0] for i in triangle_list_bounds(Primitives)]
+        n_tiles = math.pow(3 * multiprocessing.cpu_count(), 1.0 / 3)
+        TileSize = int(math.ceil(max(size) / Resolution / n_tiles))
+    TileSize = max(1, int(TileSize))
+
+    tiles = bin_tris_to_tiles(Primitives, Resolution, TileSize)
+    sys.stderr.write("Binned %d triangles into %d tiles of %d voxels on a side\n" %
+                     (len(Primitives), len(tiles), TileSize))
+
+    queues = output_queues(len(tiles))
+    procs = [
+        multiprocessing.Process(
+            target=split_tris_tile,
+            args=(tris, Resolution, tile, TileSize, q))
+        for (tile, tris), q in zip(tiles.iteritems(), queues)
+    ]
+    sys.stderr.write("Prepared %d processes of work\n" % len(procs))
+
+    pts = []
+    run_process_pool(procs, queues, pts.extend)
+    return pts
+
+
 def p_norm(coords, p):
     """
     Return the p-norm of the list.
@@ -448,11 +1224,55 @@ def p_norm(coords, p):
     return math.pow(sum([math.pow(c, p) for c in coords]), 1.0 / p)
 
 
-def integral_ball(radius, norm=lambda x, y, z: p_norm((x, y, z), 2)):
+def point_set(pts):
+    """
+    Return the given points as a container with fast membership tests. Sets and
+    dicts (mapping points to blocks) are returned as they are, and shared with the
+    caller rather than copied, so must not be modified.
+    """
+    if isinstance(pts, (set, frozenset, dict)):
+        return pts
+    return set(pts)
+
+
+# The shells of the Euclidean integral ball, by radius, and the balls themselves,
+# ordered from the outermost shell in, by radius. Both are filled in on demand.
+BALL_SHELLS = [[(0, 0, 0)]]
+BALLS = dict()
+
+
+def ball_shells(radius):
+    """
+    Return the shells of the Euclidean integral ball of the given radius, where
+    shell r holds the integer coordinates within r units of the origin but not
+    within r - 1 units. The shells of smaller balls are reused.
+    """
+    while len(BALL_SHELLS) <= radius:
+        r = len(BALL_SHELLS)
+        coord_range = range(-r, r + 1)
+        BALL_SHELLS.append([(x, y, z)
+                            for x in coord_range for y in coord_range
+                            for z in coord_range
+                            if r - 1 < p_norm((x, y, z), 2) <= r])
+    return BALL_SHELLS[:radius + 1]
+
+
+def integral_ball(radius, norm=None):
     """
     Given a radius, find all integer coordinates within that radius of the origin
-    in three dimensional Euclidean space (by default).
+    in three dimensional Euclidean space (by default). Euclidean balls are cached,
+    so must not be modified, and are ordered from the outermost shell in, so that
+    tests for a missing neighbour find one sooner. The parallel helpers fill in the
+    cache before forking their workers, so that every worker shares it.
     """
+    if norm is None and isinstance(radius, (int, long)):
+        if radius not in BALLS:
+            BALLS[radius] = [p for shell in reversed(ball_shells(radius))
+                             for p in shell]
+        return BALLS[radius]
+    if norm is None:
+        norm = lambda x, y, z: p_norm((x, y, z), 2)
+
     coord_range = range(-radius, radius + 1)
     brush = [(x, y, z)
              for x in coord_range for y in coord_range for z in coord_range
@@ -460,7 +1280,11 @@ def integral_ball(radius, norm=lambda x, y, z: p_norm((x, y, z), 2)):
     return brush
 
 
-def parallel():
+def shared_memory():
+    """
+    Return whether /dev/shm is available, which multiprocessing Queues and Pools
+    need for their semaphores.
+    """
     shm_stat = None
     try:
         shm_stat = os.stat('/dev/shm')
@@ -470,10 +1294,19 @@ def parallel():
     return shm_stat is not None
 
 
+def parallel():
+    """
+    Return whether the work can be spread over several processes. Without /dev/shm
+    the results are returned through pipes, which need processes to be forked.
+    """
+    return shared_memory() or os.name == 'posix'
+
+
 def parallel_hollow(pts, radius=1):
     """
     Perform model hollowing in parallel across cpu_count() processes.
     """
+    integral_ball(radius)
     return list_parallelize(pts, (radius, pts), hollow)
 
 
@@ -493,12 +1326,12 @@ def hollow(pts, radius=1, all_pts=None, output_queue=None):
     start_time = time.time()
     last_print_time = time.time()
     npts = 0
-    orig_pts = dict([(p, False) for p in all_pts])
-    for p in orig_pts.keys():
+    all_pts = point_set(all_pts)
+    ret = []
+    for p in pts:
         for b in brush:
-            t = TUPLE_ADD(p, b)
-            if t not in orig_pts:
-                orig_pts[p] = True
+            if TUPLE_ADD(p, b) not in all_pts:
+                ret.append(p)
                 break
         npts += 1
         if output_queue is None and time.time() - last_print_time > 0.5:
@@ -509,7 +1342,6 @@ def hollow(pts, radius=1, all_pts=None, output_queue=None):
                 (len(pts) - npts) * (time.time() - start_time) / npts
             ))
 
-    ret = [p for p, c in orig_pts.iteritems() if c]
     if output_queue is not None:
         output_queue.put(ret)
     return ret
@@ -521,34 +1353,31 @@ def list_parallelize(items, args, func):
     call that function like map but with chosen arguments using Process()
     objects. Assume that the function given takes in a Queue() as a final argument.
     """
+    if not isinstance(items, list):
+        items = list(items)
     items_per_proc = int(
         math.ceil(1.0 * len(items) / multiprocessing.cpu_count()))
     item_chunks = [
         items[i:i + items_per_proc]
         for i in xrange(0, len(items), items_per_proc)
     ]
-    output_queue = multiprocessing.Queue()
+    queues = output_queues(len(item_chunks))
     procs = [
         multiprocessing.Process(
-            target=func, args=(chunk, ) + args + (output_queue, ))
-        for chunk in item_chunks
+            target=func, args=(chunk, ) + args + (q, ))
+        for chunk, q in zip(item_chunks, queues)
     ]
 
-    for p in procs:
-        p.start()
-    running_procs = [p for p in procs]
+    for p, q in zip(procs, queues):
+        start_process(p, q)
+    running = zip(procs, queues)
 
     ret = set()
-    while len(running_procs) > 0:
-        for p in running_procs:
+    while len(running) > 0:
+        for p, _ in running:
             p.join(0.0)
-        while not output_queue.empty():
-            ret.update(output_queue.get())
+        running = drain_queues(running, ret.update)
         time.sleep(0.25)
-        running_procs = [p for p in running_procs if p.is_alive()]
-
-    while not output_queue.empty():
-        ret.update(output_queue.get())
 
     return list(ret)
 
@@ -557,6 +1386,7 @@ def parallel_morphological_dilate(pts, radius=2):
     """
     Perform morphological dilation in parallel across cpu_count() processes.
     """
+    integral_ball(radius)
     return list_parallelize(pts, (radius, ), morphological_dilate)
 
 
@@ -564,6 +1394,7 @@ def parallel_morphological_erode(pts, radius=2):
     """
     Perform morphological erosion in parallel across cpu_count() processes.
     """
+    integral_ball(radius)
     return list_parallelize(pts, (radius, pts), morphological_erode)
 
 
@@ -601,42 +1432,511 @@ def morphological_dilate(pts, radius=2, output_queue=None):
     return ret
 
 
-def morphological_erode(pts, radius=2, all_pts=None, output_queue=None):
+def morphological_erode(pts, radius=2, all_pts=None, output_queue=None):
+    """
+    Given a list of tyuples of integer coordinates, all of the same dimension,
+    erode the list of points to include only those points that include every
+    point within radius units of it.
+    """
+    if all_pts is None:
+        all_pts = pts
+
+    brush = integral_ball(radius)
+    if len(brush) == 1:
+        return pts
+
+    start_time = time.time()
+    last_print_time = time.time()
+    npts = 0
+    all_pts = point_set(all_pts)
+    ret = []
+    for p in pts:
+        for b in brush:
+            if TUPLE_ADD(p, b) not in all_pts:
+                break
+        else:
+            ret.append(p)
+        npts += 1
+        if output_queue is None and time.time() - last_print_time > 0.5:
+            last_print_time = time.time()
+            sys.stderr.write("%d/%d (ETA: %f)\n" % (
+                npts,
+                len(pts),
+                (len(pts) - npts) * (time.time() - start_time) / npts
+            ))
+
+    if output_queue is not None:
+        output_queue.put(ret)
+    return ret
+
+
+def boundary_pts(pts, all_pts):
+    """
+    Return the points of pts that have at least one of their six face neighbours
+    missing from the set all_pts.
+    """
+    return [p for p in pts
+            if any(TUPLE_ADD(p, v) not in all_pts for v in UNIT_VECTORS)]
+
+
+def frontier_cells(pts, all_pts):
+    """
+    Return the set of empty cells (those not in the set all_pts) that are face
+    neighbours of the points in pts.
+    """
+    cells = set()
+    for p in pts:
+        for v in UNIT_VECTORS:
+            t = TUPLE_ADD(p, v)
+            if t not in all_pts:
+                cells.add(t)
+    return cells
+
+
+def frontier_reach(pts, radius=2, all_pts=None, output_queue=None):
+    """
+    Return the points of all_pts that lie within radius units of an empty cell
+    next to one of the points in pts. Over the whole cloud, these are the points
+    that erosion removes and hollowing keeps: since a ball holds every lattice
+    path from its centre that heads straight for a point inside it, any point with
+    an empty cell in its ball has one of the frontier cells in its ball too. Only
+    the frontier is scanned with the brush, and the interior is never visited.
+    """
+    if all_pts is None:
+        all_pts = pts
+    all_pts = point_set(all_pts)
+
+    brush = integral_ball(radius)
+    reached = set()
+    for c in frontier_cells(pts, all_pts):
+        for b in brush:
+            t = TUPLE_ADD(c, b)
+            if t in all_pts:
+                reached.add(t)
+
+    ret = list(reached)
+    if output_queue is not None:
+        output_queue.put(ret)
+    return ret
+
+
+def frontier_hollow(pts, radius=1):
+    """
+    Perform hollowing by keeping only the points within radius units of the
+    frontier of the cloud.
+    """
+    if len(integral_ball(radius)) == 1:
+        return pts
+    return frontier_reach(pts, radius)
+
+
+def parallel_frontier_hollow(pts, radius=1):
+    """
+    Perform frontier hollowing in parallel across cpu_count() processes.
+    """
+    if len(integral_ball(radius)) == 1:
+        return pts
+    return list_parallelize(pts, (radius, pts), frontier_reach)
+
+
+def pts_to_columns(pts, margin=0):
+    """
+    Convert a list of points to a dict that maps each (x, y) column to an integer
+    bitmask along z, where bit k stands for z = z0 + k. Returns the dict and z0, which
+    is margin units below the lowest point, leaving room to shift columns down.
+    """
+    columns = dict()
+    if len(pts) == 0:
+        return columns, 0
+    z0 = min([p[2] for p in pts]) - margin
+    for p in pts:
+        c = (p[0], p[1])
+        columns[c] = columns.get(c, 0) | (1 << (p[2] - z0))
+    return columns, z0
+
+
+def columns_to_pts(columns, z0):
+    """
+    Convert a dict of column bitmasks, as produced by pts_to_columns, back to a
+    list of points.
+    """
+    pts = []
+    for (x, y), bits in columns.iteritems():
+        while bits:
+            low = bits & -bits
+            pts.append((x, y, z0 + low.bit_length() - 1))
+            bits ^= low
+    return pts
+
+
+def ball_column_heights(radius):
+    """
+    Return a dict that maps each (x, y) offset of the Euclidean integral ball of the
+    given radius to the largest z offset in that column of the ball. Every column of
+    the ball is a contiguous run from -h to h.
+    """
+    heights = dict()
+    for (x, y, z) in integral_ball(radius):
+        heights[(x, y)] = max(heights.get((x, y), 0), abs(z))
+    return heights
+
+
+def column_runs(bits, radius, combine):
+    """
+    Return the list of a column bitmask combined with itself shifted by up to h
+    places either way, for each h from 0 to radius.
+    """
+    runs = [bits]
+    for h in xrange(1, radius + 1):
+        runs.append(combine(combine(runs[-1], bits << h), bits >> h))
+    return runs
+
+
+def bitset_dilated_columns(columns, radius):
+    """
+    Return the dict of column bitmasks produced by morphological dilation of the
+    given columns, where every column of the brush is applied to a whole column of
+    points with a few shifts and ORs. The columns need radius bits of room below
+    their lowest point.
+    """
+    heights = ball_column_heights(radius)
+    dilated = dict()
+    for (x, y), bits in columns.iteritems():
+        runs = column_runs(bits, radius, lambda a, b: a | b)
+        for (dx, dy), h in heights.iteritems():
+            c = (x + dx, y + dy)
+            dilated[c] = dilated.get(c, 0) | runs[h]
+    return dilated
+
+
+def bitset_dilate(pts, radius=2):
+    """
+    Perform morphological dilation on bitmask columns.
+    """
+    if len(integral_ball(radius)) == 1:
+        return pts
+    columns, z0 = pts_to_columns(pts, radius)
+    return columns_to_pts(bitset_dilated_columns(columns, radius), z0)
+
+
+def bitset_eroded_columns(columns, radius):
+    """
+    Return the dict of column bitmasks left after morphological erosion of the given
+    columns. A point survives if its own column, shifted by up to h places either
+    way, and likewise every neighbouring column of the brush, are all filled.
+    """
+    heights = ball_column_heights(radius)
+    runs = dict([(c, column_runs(bits, radius, lambda a, b: a & b))
+                 for c, bits in columns.iteritems()])
+    eroded = dict()
+    for (x, y) in columns:
+        bits = runs[(x, y)][radius]
+        for (dx, dy), h in heights.iteritems():
+            if not bits:
+                break
+            neighbour = runs.get((x + dx, y + dy))
+            bits = bits & neighbour[h] if neighbour is not None else 0
+        if bits:
+            eroded[(x, y)] = bits
+    return eroded
+
+
+def bitset_erode(pts, radius=2):
+    """
+    Perform morphological erosion on bitmask columns.
+    """
+    if len(integral_ball(radius)) == 1:
+        return pts
+    columns, z0 = pts_to_columns(pts)
+    return columns_to_pts(bitset_eroded_columns(columns, radius), z0)
+
+
+def bitset_close(pts, dilate_radius=2, erode_radius=2):
+    """
+    Perform morphological dilation followed by erosion on bitmask columns, without
+    converting the dilated columns back to points in between.
+    """
+    columns, z0 = pts_to_columns(pts, dilate_radius)
+    if len(integral_ball(dilate_radius)) > 1:
+        columns = bitset_dilated_columns(columns, dilate_radius)
+    if len(integral_ball(erode_radius)) > 1:
+        columns = bitset_eroded_columns(columns, erode_radius)
+    return columns_to_pts(columns, z0)
+
+
+def bitset_hollow(pts, radius=1):
+    """
+    Perform hollowing on bitmask columns, keeping the points that erosion removes.
+    """
+    if len(integral_ball(radius)) == 1:
+        return pts
+    columns, z0 = pts_to_columns(pts)
+    eroded = bitset_eroded_columns(columns, radius)
+    return columns_to_pts(
+        dict([(c, bits & ~eroded.get(c, 0)) for c, bits in columns.iteritems()]), z0)
+
+
+def column_fill(seeds, free, height):
+    """
+    Flood along a column bitmask from the seed bits through the free bits, in both
+    directions, with a number of steps logarithmic in the column height.
+    """
+    filled = seeds
+    for shift in (lambda a, s: a << s, lambda a, s: a >> s):
+        g = seeds
+        p = free
+        s = 1
+        while s < height:
+            g |= p & shift(g, s)
+            p &= shift(p, s)
+            s <<= 1
+        filled |= g
+    return filled
+
+
+def bitset_flood_hollow(pts):
+    """
+    Perform flood-fill hollowing on bitmask columns: flood the empty space from
+    outside the bounding box of the points, and keep only the points that the flood
+    touches. Floods up and down columns take a logarithmic number of steps, and
+    columns are only revisited when a neighbouring column's flood grows.
+    """
+    if len(pts) == 0:
+        return pts
+    columns, z0 = pts_to_columns(pts, 1)
+    m, M = bounding_box(pts)
+    height = M[2] - z0 + 2
+    full = (1 << height) - 1
+    # The bounding box is padded by one unit on every side, and the flood starts from
+    # every empty cell in the padding.
+    xs = range(m[0] - 1, M[0] + 2)
+    ys = range(m[1] - 1, M[1] + 2)
+    ends = 1 | (1 << (height - 1))
+    flooded = dict()
+    work = set()
+    for x in xs:
+        for y in ys:
+            c = (x, y)
+            free = full & ~columns.get(c, 0)
+            if x in (xs[0], xs[-1]) or y in (ys[0], ys[-1]):
+                flooded[c] = free
+            else:
+                flooded[c] = column_fill(free & ends, free, height)
+            work.add(c)
+
+    while work:
+        (x, y) = c = work.pop()
+        free = full & ~columns.get(c, 0)
+        reach = 0
+        for (dx, dy) in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            reach |= flooded.get((x + dx, y + dy), 0)
+        seeds = reach & free & ~flooded[c]
+        if seeds:
+            flooded[c] = column_fill(flooded[c] | seeds, free, height)
+            for (dx, dy) in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                if (x + dx, y + dy) in flooded:
+                    work.add((x + dx, y + dy))
+
+    touched = dict()
+    for (x, y), bits in columns.iteritems():
+        f = flooded[(x, y)]
+        reach = (f << 1) | (f >> 1)
+        for (dx, dy) in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            reach |= flooded.get((x + dx, y + dy), 0)
+        touched[(x, y)] = bits & reach
+    return columns_to_pts(touched, z0)
+
+
+def bin_pts_to_tiles(pts, TileSize, margin=0):
+    """
+    Bin points into cubic tiles of TileSize voxels on a side, returning a dict that
+    maps each tile index to the list of points within margin units (in every
+    dimension) of that tile. Points near a tile boundary are placed in every tile
+    they are near.
+    """
+    tiles = dict()
+    for p in pts:
+        tmin = [(c - margin) // TileSize for c in p]
+        tmax = [(c + margin) // TileSize for c in p]
+        for i in xrange(tmin[0], tmax[0] + 1):
+            for j in xrange(tmin[1], tmax[1] + 1):
+                for k in xrange(tmin[2], tmax[2] + 1):
+                    tiles.setdefault((i, j, k), []).append(p)
+    return tiles
+
+
+def closing_tile_size(dilate_radius, erode_radius):
+    """
+    Return the edge length of the tiles to perform closing with the given radii in,
+    which is at least four times the margin that each tile carries.
+    """
+    return max(CLOSING_TILE_SIZE, 4 * (dilate_radius + erode_radius))
+
+
+def morphological_close_tiles(tiles, dilate_radius=2, erode_radius=2,
+                              TileSize=None, frontier=False, output_queue=None):
+    """
+    Given a list of (tile index, points) pairs as produced by bin_pts_to_tiles with
+    a margin of dilate_radius + erode_radius, perform morphological dilation
+    followed by erosion, and return the points of the result that fall inside each
+    tile. Only the dilated points within erode_radius of the tile being processed
+    are held at once. If frontier is set, the dilation brush is only applied at the
+    boundary points of the cloud, and the erosion brush at its frontier cells, as
+    in frontier_reach.
+    """
+    if TileSize is None:
+        TileSize = closing_tile_size(dilate_radius, erode_radius)
+    dilate_brush = integral_ball(dilate_radius)
+    erode_brush = integral_ball(erode_radius)
+
+    ret = []
+    for tile, pts in tiles:
+        lo = [t * TileSize for t in tile]
+        hi = [l + TileSize for l in lo]
+        near_lo = [l - erode_radius for l in lo]
+        near_hi = [h + erode_radius for h in hi]
+        near = lambda t: (near_lo[0] <= t[0] < near_hi[0] and
+                          near_lo[1] <= t[1] < near_hi[1] and
+                          near_lo[2] <= t[2] < near_hi[2])
+        inside = lambda t: (lo[0] <= t[0] < hi[0] and lo[1] <= t[1] < hi[1] and
+                            lo[2] <= t[2] < hi[2])
+
+        # The dilated points near enough to the tile to be looked at by the erosion
+        if frontier:
+            pts_set = set(pts)
+            dilated = set([p for p in pts if near(p)])
+            brushed = boundary_pts(pts, pts_set)
+        else:
+            dilated = set()
+            brushed = pts
+        for p in brushed:
+            for b in dilate_brush:
+                t = TUPLE_ADD(p, b)
+                if near(t):
+                    dilated.add(t)
+
+        if frontier:
+            # Every empty cell near the tile is known to be empty, so the frontier
+            # cells near the tile are enough to erode every point inside it.
+            eroded = set()
+            for c in frontier_cells(dilated, dilated):
+                if not near(c):
+                    continue
+                for b in erode_brush:
+                    eroded.add(TUPLE_ADD(c, b))
+            ret.extend([p for p in dilated if inside(p) and p not in eroded])
+            continue
+
+        for p in dilated:
+            if not inside(p):
+                continue
+            for b in erode_brush:
+                if TUPLE_ADD(p, b) not in dilated:
+                    break
+            else:
+                ret.append(p)
+
+    if output_queue is not None:
+        output_queue.put(ret)
+    return ret
+
+
+def parallel_morphological_close(pts, dilate_radius=2, erode_radius=2,
+                                 TileSize=None, frontier=False):
+    """
+    Perform fused morphological closing in parallel across cpu_count() processes,
+    where each process receives only the points near the tiles it is given.
+    """
+    if TileSize is None:
+        TileSize = closing_tile_size(dilate_radius, erode_radius)
+    integral_ball(max(dilate_radius, erode_radius))
+    tiles = bin_pts_to_tiles(pts, TileSize, dilate_radius + erode_radius)
+    return list_parallelize(tiles.items(),
+                            (dilate_radius, erode_radius, TileSize, frontier),
+                            morphological_close_tiles)
+
+
+def morphological_close(pts, dilate_radius=2, erode_radius=2,
+                        TileSize=None, frontier=False):
+    """
+    Perform morphological dilation followed by erosion one tile at a time, without
+    materializing the whole dilated cloud. The result is the same as that of
+    morphological_erode(morphological_dilate(pts, dilate_radius), erode_radius).
+    If TileSize is not given, it is chosen from the radii by closing_tile_size().
+    """
+    if TileSize is None:
+        TileSize = closing_tile_size(dilate_radius, erode_radius)
+    tiles = bin_pts_to_tiles(pts, TileSize, dilate_radius + erode_radius)
+    return morphological_close_tiles(tiles.iteritems(), dilate_radius, erode_radius,
+                                     TileSize, frontier)
+
+
+def mirror_point(p, i):
+    """
+    Negate the i'th (zero-based) coordinate of a point.
+    """
+    return tuple([-c if j == i else c for j, c in enumerate(p)])
+
+
+def fold_points(pts, dim):
+    """
+    Fold a list of points onto the non-negative side of the plane through the origin
+    perpendicular to the given dimension (1, 2 or 3). For a cloud reflected in that
+    plane, this is the half of the cloud on that side.
+    """
+    i = dim - 1
+    return set([p if p[i] >= 0 else mirror_point(p, i) for p in pts])
+
+
+def symmetric_apply(pts, dim, halo, func):
     """
-    Given a list of tyuples of integer coordinates, all of the same dimension,
-    erode the list of points to include only those points that include every
-    point within radius units of it.
+    Given the non-negative half of a cloud that is symmetric in the given dimension,
+    apply func as though to the whole cloud, returning only the non-negative half of
+    the result. Points within halo units of the plane are mirrored across it first,
+    so func sees the other side of the plane wherever it looks no further than the
+    halo. A dictionary mapping points to blocks is mirrored as mirror_blocks() does,
+    so func sees the mirrored slopes as well. If dim is None, func is applied to the
+    points as they are.
     """
-    if all_pts is None:
-        all_pts = pts
-
-    brush = integral_ball(radius)
-    if len(brush) == 1:
-        return pts
+    if dim is None:
+        return func(pts)
+
+    i = dim - 1
+    if isinstance(pts, dict):
+        whole = dict(pts)
+        whole.update(mirror_blocks(
+            dict([(p, b) for p, b in pts.iteritems() if 0 < p[i] <= halo]), dim))
+        result = func(whole)
+    else:
+        ghost = [mirror_point(p, i) for p in pts if 0 < p[i] <= halo]
+        result = func(list(pts) + ghost)
+    if isinstance(result, dict):
+        return dict([(p, b) for p, b in result.iteritems() if p[i] >= 0])
+    return [p for p in result if p[i] >= 0]
 
-    start_time = time.time()
-    last_print_time = time.time()
-    npts = 0
-    orig_pts = dict([(p, True) for p in all_pts])
-    for p in pts:
-        for b in brush:
-            t = TUPLE_ADD(p, b)
-            if t not in orig_pts:
-                orig_pts[p] = False
-                break
-        npts += 1
-        if output_queue is None and time.time() - last_print_time > 0.5:
-            last_print_time = time.time()
-            sys.stderr.write("%d/%d (ETA: %f)\n" % (
-                npts,
-                len(pts),
-                (len(pts) - npts) * (time.time() - start_time) / npts
-            ))
 
-    ret = [p for p in pts if orig_pts[p]]
-    if output_queue is not None:
-        output_queue.put(ret)
-    return ret
+def mirror_blocks(points, dim):
+    """
+    Given the non-negative half of a symmetric model, as a dictionary mapping
+    coordinates to block values, add the mirror image of every block on the other
+    side of the plane, with the forward and up vectors of sloped blocks mirrored.
+    Sloped blocks on the plane that point across it have no mirror image, and are
+    dropped.
+    """
+    i = dim - 1
+    mirrored = dict()
+    for p, block in points.iteritems():
+        if block != 0:
+            (forward, up) = block[1]
+            if p[i] == 0 and (forward[i] != 0 or up[i] != 0):
+                continue
+            mirrored_block = (block[0], (mirror_point(forward, i), mirror_point(up, i)))
+        else:
+            mirrored_block = 0
+        mirrored[p] = block
+        if p[i] != 0:
+            mirrored[mirror_point(p, i)] = mirrored_block
+    return mirrored
 
 
 def adjacency_vectors(position, forward, points):
@@ -649,23 +1949,40 @@ def adjacency_vectors(position, forward, points):
     # one vector for which this is true, take the director that dots to -1 with
     # the vector satisfying this criteria
     adj = []
-    for v in UNIT_VECTORS:
-        if TUPLE_DOT(forward, v) != 0:
-            continue
-        else:
-            p = TUPLE_ADD(position, v)
-            if p in points and points[p] == 0:
-                adj.append(v)
-    return [(vec, [v for v in UNIT_VECTORS if TUPLE_DOT(v, vec) == -1][0]) for vec in adj]
+    for v in PERPENDICULAR_VECTORS[forward]:
+        p = TUPLE_ADD(position, v)
+        if p in points and points[p] == 0:
+            adj.append(v)
+    return [(vec, OPPOSITE_VECTORS[vec]) for vec in adj]
+
+
+def neighbourhood_mask(position, points, offsets=EDGE_OFFSETS):
+    """
+    Return the neighbourhood mask of a position, with the bits of the given neighbour
+    offsets set where there is a full block.
+    """
+    x, y, z = position
+    mask = 0
+    for o in offsets:
+        p = (x + o[0], y + o[1], z + o[2])
+        if p in points and points[p] == 0:
+            mask |= NEIGHBOUR_BITS[o]
+    return mask
 
-def slope_check_single(position, forward, points, aggressive=False, dim_weight=[1,2,4]):
+
+def slope_check_single(position, forward, points, aggressive=False, dim_weight=[1,2,4],
+                       adjacencies=None):
     """
     Given a single point and a forward direction, determine whether a slope is suitable
     in the given forward direction, and if so, what slope value. Add the resulting values
     to the points dictionary
+
+    If the adjacencies for the position have already been looked up in the
+    ADJACENCY_TABLES, they can be passed in.
     """
     # In the case that the adjacency is ambiguous, try them all.
-    adjacencies = adjacency_vectors(TUPLE_ADD(position, forward), forward, points)
+    if adjacencies is None:
+        adjacencies = adjacency_vectors(TUPLE_ADD(position, forward), forward, points)
     
     # If we're not aggressively smoothing, and there's more than one adjacency, skip them
     # as this is an interior corner.
@@ -673,9 +1990,7 @@ def slope_check_single(position, forward, points, aggressive=False, dim_weight=[
         return
 
     for down_vec, up_vec in adjacencies:
-        perpendicular_vectors = [
-            v for v in UNIT_VECTORS if TUPLE_DOT(v, forward) == 0 and v != down_vec
-        ]
+        perpendicular_vectors = PERPENDICULAR_EXCLUDING[(forward, down_vec)]
 
         # For each unit vector that is perpendicular to the forward vector, move up
         # to the maximum slope length along the forward vector, checking all around
@@ -800,73 +2115,89 @@ def slope_check_single(position, forward, points, aggressive=False, dim_weight=[
     return points
 
 
+def corner_probes(forward):
+    """
+    Given the forward vector of a sloped block, list the edge neighbour offsets at
+    which another slope could form a corner with it, in the order of EDGE_OFFSETS.
+    Each entry is the offset, the forward vector the other slope must have, and
+    whether the pair forms a closed-off interior corner (CutCorner).
+    """
+    probes = []
+    for offset in EDGE_OFFSETS:
+        for other_forward in PERPENDICULAR_VECTORS[forward]:
+            # For a closed off interior corner, the two slopes need to have
+            # position+forward be equal.
+            if TUPLE_ADD(offset, other_forward) == forward:
+                probes.append((offset, other_forward, True))
+            # For a simple corner, the two slopes need to have position-forward be
+            # equal.
+            elif TUPLE_SUB(offset, other_forward) == TUPLE_SCALE(-1, forward):
+                probes.append((offset, other_forward, False))
+    return probes
+
+
+CORNER_PROBES = dict([(f, corner_probes(f)) for f in UNIT_VECTORS])
+
+
+def slope_index(Points):
+    """
+    Given a dictionary mapping coordinates to block types, build an index of only the
+    sloped blocks, grouped by slope type and up vector and mapping the coordinates
+    of each slope to its forward vector. Also return the sloped blocks in the order
+    they are laid out in the blueprint.
+    """
+    groups = dict()
+    slopes = []
+    for coord, block in Points.iteritems():
+        if block == 0 or block is None:
+            continue
+        slopes.append((coord, block))
+        groups.setdefault((block[0], block[1][1]), dict())[coord] = block[1][0]
+    slopes.sort(key=lambda s: BLUEPRINT_ORDER(s[0]))
+    return (groups, slopes)
+
+
 def fill_corners(Points):
     """
     For a given set of points (dictionary mapping coordinates to block type), find all unambiguous
     places to place corner blocks.
     """
-    corner_mapping = {
-        ((1, 1), (1, 1)): 'Corner'
-    }
     # For a location to be valid for a corner filling, there needs to be exactly
     # two adjacent blocks with appropriate orientations that are the same time.
-    offsets = [(i, j, k)
-               for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
-               if abs(i) + abs(j) + abs(k) == 2]
+    # Only slopes of the same type and part, with the same up vector, can form a
+    # corner, so each slope is only compared against its own group of the index.
+    groups, slopes = slope_index(Points)
 
-    # Iterate over all blocks in the object at this point, only considering slant
-    # blocks, and identify any where there is a candidate nearby.
     corners = dict()
-    for coord, block in Points.iteritems():
-        # If it is a plain cube, skip it.
-        if block == 0:
-            continue
+    for coord, block in slopes:
+        group = groups[(block[0], block[1][1])]
 
-        # Otherwise, look at all of the midpoints of the edges of the cube centred
-        # on this location for a block that is the same as this.
-        for offset in offsets:
+        # Look at the midpoints of the edges of the cube centred on this location
+        # where a slope with a perpendicular forward vector would form a corner.
+        for offset, other_forward, cut_corner in CORNER_PROBES[block[1][0]]:
             other_coord = TUPLE_ADD(coord, offset)
-            other_block = Points.get(other_coord, None)
-            # If this point isn't there, or it is a cube, then move to the next offset.
-            if other_block is None or other_block == 0:
+            if group.get(other_coord, None) != other_forward:
                 continue
 
-            # Otherwise, check to see that the slope type and the slope part
-            # match. Then check that the up vectors match. Then check that the
-            # forward vectors are perpendicular and cross to 
-            if block[0] == other_block[0] and \
-                block[1][1] == other_block[1][1] and \
-                TUPLE_DOT(block[1][0], other_block[1][0]) == 0:
-                corner_type = None
-                corner_coord = None
-                # Additional check for an interior closed-off corner:
-                #  - The two slopes need to have position+forward be equal.
-                if TUPLE_ADD(coord, block[1][0]) == TUPLE_ADD(other_coord, other_block[1][0]):
-                    corner_type = 'CutCorner'
-                    # For a closed off interior corner, the corner coordiante
-                    # is the position of one slope MINUS the forward direction
-                    # of the other slope.
-                    corner_coord = TUPLE_SUB(coord, other_block[1][0])
-
-                # Additional check for simple corner:
-                #  - The two slopes need to have position-forward be equal.
-                if TUPLE_SUB(coord, block[1][0]) == TUPLE_SUB(other_coord, other_block[1][0]):
-                    corner_type = ('Corner', block[0])
-                    # For a normal interior corner, the corner coordinate is
-                    # the position of one of the slopes plus the forward of
-                    # the other slope.
-                    corner_coord = TUPLE_ADD(coord, other_block[1][0])
-
-                # If neither corner type was found, then do nothing.
-                if corner_type is None:
-                    continue
-                # If a corner type was found, ensure that the space is empty in
-                # the existing point set.
-                elif corner_coord not in Points:
-                    corners[corner_coord] = (
-                        corner_type,
-                        block[1]
-                    )
+            if cut_corner:
+                corner_type = 'CutCorner'
+                # For a closed off interior corner, the corner coordiante
+                # is the position of one slope MINUS the forward direction
+                # of the other slope.
+                corner_coord = TUPLE_SUB(coord, other_forward)
+            else:
+                corner_type = ('Corner', block[0])
+                # For a normal interior corner, the corner coordinate is
+                # the position of one of the slopes plus the forward of
+                # the other slope.
+                corner_coord = TUPLE_ADD(coord, other_forward)
+
+            # Ensure that the space is empty in the existing point set.
+            if corner_coord not in Points:
+                corners[corner_coord] = (
+                    corner_type,
+                    block[1]
+                )
 
     Points.update(corners)
     return Points
@@ -880,73 +2211,106 @@ def smooth_pts(PointTriples, aggressive=False):
     """
     # First, create a dict that maps from the points to the slope values
     pts = dict([(p, 0) for p in PointTriples])
+    smooth_in_order(sorted(pts, key=BLUEPRINT_ORDER), pts, aggressive)
+
+    # Throw away any points with a value of None
+    pts = dict([(k, v) for k, v in pts.iteritems() if v is not None])
+    return pts
+
 
+def smooth_in_order(order, pts, aggressive=False):
+    """
+    Place the slopes for each of the points in order, which must all be full blocks
+    of the dictionary of points, as smooth_pts() does. Slopes are placed in the
+    dictionary, and are only resolved against the slopes already there, so the
+    points must be given in the same order for the same result.
+    """
     start_time = time.time()
     last_print_time = time.time()
     npts = 0
     # For each point check along each unit vector to see if there are any blocks
     # that would make that direction an interior corner.
-    for p in pts.keys():
+    for p in order:
+        # Full blocks are never replaced during smoothing, so the neighbourhood of each
+        # point only needs to be examined once for all directions.
+        mask = neighbourhood_mask(p, pts)
         for v in UNIT_VECTORS:
-            slope_check_single(p, v, pts, aggressive)
+            adjacency_mask, adjacency_candidates = ADJACENCY_TABLES[v]
+            adjacencies = adjacency_candidates[mask & adjacency_mask]
+            # Without an adjacency there is nothing for a slope to rest on, and with
+            # more than one this is an interior corner unless smoothing aggressively.
+            if len(adjacencies) == 0 or (len(adjacencies) > 1 and not aggressive):
+                continue
+            slope_check_single(p, v, pts, aggressive, adjacencies=adjacencies)
         npts += 1
         if time.time() - last_print_time > 0.5:
             last_print_time = time.time()
             sys.stderr.write("%d/%d (ETA: %f)\n" % (
                 npts,
-                len(pts),
-                (len(pts) - npts) * (time.time() - start_time) / npts
+                len(order),
+                (len(order) - npts) * (time.time() - start_time) / npts
             ))
-
-    # Throw away any points with a value of None
-    pts = dict([(k, v) for k, v in pts.iteritems() if v is not None])
     return pts
 
 
-def map_to_empyrion_codes(points):
-    block_type_mapping = {
-        0: 0x0,
-        (1, 1): 0x14,
-        'CutCorner': 0x02,
-        ('Corner', (1, 1)): 0x0c,
-        (2, 1): 0x12,
-        (2, 2): 0x10,
-        ('Corner', (2, 1)): 0x08,
-        ('Corner', (2, 2)): 0x0a
-    }
-    slope_code_mapping = {
-        177: ((0, 0, -1), (1, 0, 0)),
-        9: ((1, 0, 0), (0, 1, 0)),
-        137: ((1, 0, 0), (0, 0, -1)),
-        89: ((1, 0, 0), (0, 0, 1)),
-        33: ((0, 0, 1), (0, -1, 0)),
-        1: ((0, 0, 1), (0, 1, 0)),
-        97: ((0, 0, 1), (-1, 0, 0)),
-        81: ((0, -1, 0), (0, 0, 1)),
-        41: ((-1, 0, 0), (0, -1, 0)),
-        185: ((0, 1, 0), (1, 0, 0)),
-        105: ((0, 1, 0), (-1, 0, 0)),
-        129: ((0, 1, 0), (0, 0, -1)),
-        161: ((0, 0, 1), (1, 0, 0)),
-        25: ((-1, 0, 0), (0, 1, 0)),
-        153: ((-1, 0, 0), (0, 0, -1)),
-        73: ((-1, 0, 0), (0, 0, 1)),
-        49: ((0, 0, -1), (0, -1, 0)),
-        17: ((0, 0, -1), (0, 1, 0)),
-        113: ((0, 0, -1), (-1, 0, 0)),
-        65: ((0, 1, 0), (0, 0, 1)),
-        57: ((1, 0, 0), (0, -1, 0)),
-        169: ((0, -1, 0), (1, 0, 0)),
-        121: ((0, -1, 0), (-1, 0, 0)),
-        145: ((0, -1, 0), (0, 0, -1))
-    }
-    slope_orientation_mapping = dict(
-        [(v, k) for k, v in slope_code_mapping.iteritems()])
+# Mappings from the block values produced by smoothing and corner filling to the
+# Empyrion block shape and rotation codes.
+BLOCK_TYPE_MAPPING = {
+    0: 0x0,
+    (1, 1): 0x14,
+    'CutCorner': 0x02,
+    ('Corner', (1, 1)): 0x0c,
+    (2, 1): 0x12,
+    (2, 2): 0x10,
+    ('Corner', (2, 1)): 0x08,
+    ('Corner', (2, 2)): 0x0a
+}
+
+SLOPE_CODE_MAPPING = {
+    177: ((0, 0, -1), (1, 0, 0)),
+    9: ((1, 0, 0), (0, 1, 0)),
+    137: ((1, 0, 0), (0, 0, -1)),
+    89: ((1, 0, 0), (0, 0, 1)),
+    33: ((0, 0, 1), (0, -1, 0)),
+    1: ((0, 0, 1), (0, 1, 0)),
+    97: ((0, 0, 1), (-1, 0, 0)),
+    81: ((0, -1, 0), (0, 0, 1)),
+    41: ((-1, 0, 0), (0, -1, 0)),
+    185: ((0, 1, 0), (1, 0, 0)),
+    105: ((0, 1, 0), (-1, 0, 0)),
+    129: ((0, 1, 0), (0, 0, -1)),
+    161: ((0, 0, 1), (1, 0, 0)),
+    25: ((-1, 0, 0), (0, 1, 0)),
+    153: ((-1, 0, 0), (0, 0, -1)),
+    73: ((-1, 0, 0), (0, 0, 1)),
+    49: ((0, 0, -1), (0, -1, 0)),
+    17: ((0, 0, -1), (0, 1, 0)),
+    113: ((0, 0, -1), (-1, 0, 0)),
+    65: ((0, 1, 0), (0, 0, 1)),
+    57: ((1, 0, 0), (0, -1, 0)),
+    169: ((0, -1, 0), (1, 0, 0)),
+    121: ((0, -1, 0), (-1, 0, 0)),
+    145: ((0, -1, 0), (0, 0, -1))
+}
+
+SLOPE_ORIENTATION_MAPPING = dict(
+    [(v, k) for k, v in SLOPE_CODE_MAPPING.iteritems()])
+
+
+# The block type byte of each hull block that can be used for the blueprint. Small
+# steel blocks are used unless another block is asked for.
+BLOCK_TYPE_CODES = {
+    'Steel-Small': '\x87',
+    'HardenedSteel': '\x8a',
+    'CombatSteel-Large': '\x9c'
+}
+
 
+def map_to_empyrion_codes(points):
     blocks = []
     for position, block in points.iteritems():
-        blocks.append(position + (block_type_mapping[block[
-            0] if block != 0 else 0], slope_orientation_mapping[block[1]]
+        blocks.append(position + (BLOCK_TYPE_MAPPING[block[
+            0] if block != 0 else 0], SLOPE_ORIENTATION_MAPPING[block[1]]
                                   if block != 0 else 1))
     return blocks
 
@@ -1006,6 +2370,15 @@ def sparse_to_dense(positions, meta, l, w, h):
     return a
 
 
+def dense_matrix_size(l, w, h):
+    """
+    Return the approximate number of bytes used by the nested lists that
+    sparse_to_dense() builds for a model of the given dimensions.
+    """
+    return (sys.getsizeof([False] * l) * w * h + sys.getsizeof([None] * w) * h +
+            sys.getsizeof([None] * h))
+
+
 def list_subtract(l1, l2):
     return [l1[i] - l2[i] for i in range(len(l1))]
 
@@ -1015,6 +2388,38 @@ def bounding_box(positions):
     M = [max([p[i] for p in positions]) for i in range(3)]
     return (m, M)
 
+# The blueprint dimension that points up in the game.
+BLUEPRINT_UP_AXIS = 1
+
+
+def orientation_summary(pts, up_axis=BLUEPRINT_UP_AXIS):
+    """
+    Summarize how a voxel cloud sits in the game: the bounding box dimensions, the
+    aspect (longest over shortest side), the number of voxels in the bottom layer,
+    the fraction of the footprint that the bottom layer covers, and the height of
+    the centre of mass as a fraction of the height. A flat bottom has a base fill
+    close to 1 and a low centre of mass.
+    """
+    m, M = bounding_box(pts)
+    dims = [M[i] - m[i] + 1 for i in range(3)]
+    (u, a, b) = (up_axis, (up_axis + 1) % 3, (up_axis + 2) % 3)
+    footprint = set()
+    n_base = 0
+    total_height = 0
+    for p in pts:
+        footprint.add((p[a], p[b]))
+        if p[u] == m[u]:
+            n_base += 1
+        total_height += p[u] - m[u]
+    return {
+        'dims': dims,
+        'aspect': 1.0 * max(dims) / min(dims),
+        'base': n_base,
+        'base_fill': 1.0 * n_base / len(footprint),
+        'centre_height': 1.0 * total_height / len(pts) / max(dims[u] - 1, 1)
+    }
+
+
 def iterative_flood_fill(dbm, start, VisitedType):
     """
     Use a manual stack context to iteratively flood-fill the volume around the hull.
@@ -1147,7 +2552,7 @@ def flood_hollow_dbm(dbm, positions, test=lambda _: False):
         return dbm, dict([(pos, positions[pos]) for
                           pos in [p for p in positions.keys() if p not in pruned_positions]])
 
-def generate_blocks(positions, meta, flood_hollow):
+def generate_blocks(positions, meta, flood_hollow, block_type="\x87"):
     # The string used for each block, corresponds to a steel cube.
     # The four bytes are (in order):
     # - Block type
@@ -1191,9 +2596,6 @@ def generate_blocks(positions, meta, flood_hollow):
     #  > 0x04 = Corner A
     #  > 0x02 = Cut Corner
     #  > 0x00 = Full Cube
-    block_type = "\x87"
-    block_rotation = "\x01"
-    block_shape = "\x00"
     #block_string = "\x87\x01\x00\x00"
 
     # Step 1: Figure out how big the bounding box is, calculate the two opposing corners.
@@ -1264,22 +2666,77 @@ def csv_to_array(csv):
             for l in csv.strip().split("\n")]
 
 
-def build_new_bp(bp_body, positions, bp_class, flood_hollow):
-    blueprint_class_mapping = {
-        "CV": chr(8),
-        "BA": chr(2),
-        "HV": chr(16),
-        "SV": chr(4)
-    }
+def bp_section_sizes(fp, n_blocks, chunk_size=1 << 20):
+    """
+    Given a file positioned at the start of block data built by generate_blocks(),
+    and the number of blocks in it, return the name, size and deflated size of each
+    section: the header bitmask, the block records and the footer. Each section is
+    read a chunk at a time and deflated on its own, so the sizes are an estimate of
+    its share of the compressed blueprint.
+    """
+    n_hdr_bytes = struct.unpack("<L", fp.read(4))[0]
+    sizes = []
+    for name, size in [('header', n_hdr_bytes), ('blocks', 4 * n_blocks),
+                       ('footer', None)]:
+        compressor = zlib.compressobj(9)
+        n_bytes = 0
+        n_compressed = 0
+        while size is None or n_bytes < size:
+            data = fp.read(chunk_size if size is None else min(chunk_size, size - n_bytes))
+            if len(data) == 0:
+                break
+            n_bytes += len(data)
+            n_compressed += len(compressor.compress(data))
+        n_compressed += len(compressor.flush())
+        sizes.append((name, n_bytes, n_compressed))
+    return sizes
+
+
+def report_bp_section_sizes(sizes):
+    """
+    Write the section sizes returned by bp_section_sizes() to stderr.
+    """
+    for name, size, compressed_size in sizes:
+        sys.stderr.write("Blueprint %s section: %d bytes, %d bytes compressed.\n" %
+                         (name, size, compressed_size))
 
+
+def build_new_bp(bp_body, positions, bp_class, flood_hollow, block_type='Steel-Small',
+                 report_sections=False):
+    """
+    Build a blueprint from the prototype blueprint and a list of (x, y, z, shape,
+    rotation) blocks, made of the named block type. If report_sections is set, the
+    size of each section of the block data is written to stderr, which deflates each
+    section again.
+    """
     new_blocks, length, width, height = generate_blocks(
-        [tuple(p[:3]) for p in positions], [tuple(p[3:]) for p in positions], flood_hollow)
+        [tuple(p[:3]) for p in positions], [tuple(p[3:]) for p in positions], flood_hollow,
+        BLOCK_TYPE_CODES[block_type])
+
+    if report_sections:
+        report_bp_section_sizes(bp_section_sizes(StringIO.StringIO(new_blocks),
+                                                 len(positions)))
 
     sso = StringIO.StringIO()
     zf = zipfile.ZipFile(sso, 'w', zipfile.ZIP_DEFLATED)
     zf.writestr('0', new_blocks)
     zf.close()
 
+    return assemble_bp(bp_body, sso, bp_class, length, width, height)
+
+
+def assemble_bp(bp_body, sso, bp_class, length, width, height):
+    """
+    Given the prototype blueprint, a StringIO containing the zipped block data, the
+    class, and the dimensions, build the complete blueprint.
+    """
+    blueprint_class_mapping = {
+        "CV": chr(8),
+        "BA": chr(2),
+        "HV": chr(16),
+        "SV": chr(4)
+    }
+
     # The Empyrion Blueprints don't include the first PK, so don't read that.
     sso.seek(2)
     new_zip = sso.read()
@@ -1304,3 +2761,625 @@ def build_new_bp(bp_body, positions, bp_class, flood_hollow):
     new_zip
 
     return new_bp
+
+
+# The zip section of a blueprint starts at the local file header of the block data,
+# with the leading 'PK' of the signature removed.
+BP_ZIP_MARKER = '\x03\x04\x14\x00\x00\x00\x08\x00'
+# The number of set bits in each possible byte of an occupancy bitmask.
+BIT_COUNTS = [bin(i).count('1') for i in range(256)]
+
+
+def bp_zip_entry_size(buf, offset):
+    """
+    Given a buffer holding a blueprint, and the offset of its zip section, return
+    the size of the block data recorded in the zip local file header.
+    """
+    return struct.unpack("<L", buf[offset + 20:offset + 24])[0]
+
+
+def inflate_bp_zip_entry(buf, offset, chunk_size=1 << 20):
+    """
+    Given a buffer holding a blueprint (a string or an mmap), and the offset of its
+    zip section, read the local file header and generate the inflated block data one
+    chunk at a time. The CRC and size recorded in the header are checked once the
+    last chunk has been inflated.
+    """
+    if buf[offset:offset + 2] != '\x03\x04':
+        raise ValueError("Blueprint zip section has a bad local file header.")
+    (_, flags, method, _, _, crc, compressed_size, size, name_length,
+     extra_length) = struct.unpack("<HHHHHLLLHH", buf[offset + 2:offset + 28])
+    if method != zipfile.ZIP_DEFLATED or flags & 0x08:
+        raise ValueError("Blueprint zip section is not a plain deflated entry.")
+    name = buf[offset + 28:offset + 28 + name_length]
+    if name != '0':
+        raise ValueError("Blueprint zip entry is named %s, not 0." % repr(name))
+
+    start = offset + 28 + name_length + extra_length
+    end = start + compressed_size
+    if end > len(buf):
+        raise ValueError("Blueprint zip entry is truncated.")
+
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    data_crc = 0
+    data_size = 0
+    for i in xrange(start, end, chunk_size):
+        chunk = inflater.decompress(buf[i:min(i + chunk_size, end)])
+        data_crc = zlib.crc32(chunk, data_crc)
+        data_size += len(chunk)
+        yield chunk
+    chunk = inflater.flush()
+    data_crc = zlib.crc32(chunk, data_crc)
+    data_size += len(chunk)
+    yield chunk
+
+    if data_size != size:
+        raise ValueError("Blueprint block data is %d bytes, expected %d." %
+                         (data_size, size))
+    if data_crc & 0xffffffff != crc:
+        raise ValueError("Blueprint block data failed its CRC check.")
+
+
+class ChunkReader(object):
+    """
+    Reads a stream given as a sequence of string chunks, holding at most a chunk
+    and the data being read in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+
+    def read(self, size):
+        """
+        Read up to size bytes, fewer only at the end of the stream.
+        """
+        parts = []
+        n_read = 0
+        while n_read < size:
+            if self.pos == len(self.buffer):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer = chunk
+                self.pos = 0
+                continue
+            part = self.buffer[self.pos:self.pos + size - n_read]
+            self.pos += len(part)
+            n_read += len(part)
+            parts.append(part)
+        return "".join(parts)
+
+    def skip(self, size, chunk_size=1 << 20):
+        """
+        Read and discard up to size bytes, returning the number skipped.
+        """
+        skipped = 0
+        while skipped < size:
+            n = len(self.read(min(chunk_size, size - skipped)))
+            if n == 0:
+                break
+            skipped += n
+        return skipped
+
+
+def bp_zip_start(buf):
+    """
+    Given a buffer holding a blueprint, return the offset of its zip section.
+    """
+    zip_start = buf.rfind(BP_ZIP_MARKER)
+    if zip_start < 21:
+        raise ValueError("No zip section found in blueprint.")
+    return zip_start
+
+
+def bitmask_positions(bitmask, length, width):
+    """
+    Generate the coordinates of every set bit of a blueprint occupancy bitmask, in
+    the order of the block records.
+    """
+    layer = length * width
+    for i, b in enumerate(bytearray(bitmask)):
+        if b == 0:
+            continue
+        for j in range(8):
+            if b & (1 << j):
+                n = 8 * i + j
+                yield (n % length, (n // length) % width, n // layer)
+
+
+class Blueprint(object):
+    """
+    A decoded Empyrion blueprint: the dimensions, the class byte, and the block data
+    split into the occupancy bitmask, the 4-byte block records and the footer.
+    """
+
+    def __init__(self, header, stream):
+        # Everything before the zip section: the global header, dimensions, and
+        # the device groupings.
+        self.header = header
+        self.bp_class = ord(header[8])
+        self.length, self.width, self.height = struct.unpack("<LLL", header[9:21])
+
+        # The block data is read from a ChunkReader, so that each section is only
+        # held once.
+        data = stream.read(4)
+        if len(data) != 4:
+            raise ValueError("Blueprint block data is truncated before the header.")
+        n_hdr_bytes = struct.unpack("<L", data)[0]
+        self.bitmask = stream.read(n_hdr_bytes)
+        if len(self.bitmask) != n_hdr_bytes:
+            raise ValueError("Blueprint block data is truncated in the header.")
+        self.n_blocks = sum([BIT_COUNTS[b] for b in bytearray(self.bitmask)])
+
+        self.blocks = stream.read(4 * self.n_blocks)
+        if len(self.blocks) != 4 * self.n_blocks:
+            raise ValueError("Blueprint block data is truncated in the block records.")
+        footer = []
+        while True:
+            data = stream.read(1 << 20)
+            if len(data) == 0:
+                break
+            footer.append(data)
+        self.footer = "".join(footer)
+
+    @staticmethod
+    def read(filename):
+        """
+        Read and decode a blueprint file, memory-mapping it rather than reading it.
+        """
+        with open(filename, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return Blueprint.decode(buf)
+            finally:
+                buf.close()
+
+    @staticmethod
+    def decode(buf, chunk_size=1 << 20):
+        """
+        Decode a blueprint held in a string or mmap, inflating the block data one
+        chunk at a time.
+        """
+        zip_start = bp_zip_start(buf)
+        return Blueprint(buf[:zip_start],
+                         ChunkReader(inflate_bp_zip_entry(buf, zip_start, chunk_size)))
+
+    @staticmethod
+    def voxels(buf, chunk_size=1 << 20):
+        """
+        Generate every block of a blueprint held in a string or mmap as (x, y, z,
+        shape, rotation), the same form produced by map_to_empyrion_codes() and
+        consumed by build_new_bp(), in the order of the block records. The block
+        data is inflated one chunk at a time, so only the bitmask and a chunk of
+        block records are held in memory. The CRC of the block data is checked once
+        the last block has been generated.
+        """
+        zip_start = bp_zip_start(buf)
+        length, width, _ = struct.unpack("<LLL", buf[9:21])
+        stream = ChunkReader(inflate_bp_zip_entry(buf, zip_start, chunk_size))
+        data = stream.read(4)
+        if len(data) != 4:
+            raise ValueError("Blueprint block data is truncated before the header.")
+        n_hdr_bytes = struct.unpack("<L", data)[0]
+        bitmask = stream.read(n_hdr_bytes)
+        if len(bitmask) != n_hdr_bytes:
+            raise ValueError("Blueprint block data is truncated in the header.")
+        n_blocks = sum([BIT_COUNTS[b] for b in bytearray(bitmask)])
+
+        positions = bitmask_positions(bitmask, length, width)
+        n_records = max(1, chunk_size // 4)
+        for i in xrange(0, n_blocks, n_records):
+            records = bytearray(stream.read(4 * min(n_records, n_blocks - i)))
+            if len(records) != 4 * min(n_records, n_blocks - i):
+                raise ValueError(
+                    "Blueprint block data is truncated in the block records.")
+            for j in xrange(0, len(records), 4):
+                yield next(positions) + (records[j + 3], records[j + 1])
+        # Reaching the end of the stream checks the CRC.
+        stream.skip(bp_zip_entry_size(buf, zip_start))
+
+    @staticmethod
+    def read_voxels(filename, chunk_size=1 << 20):
+        """
+        Generate every block of a blueprint file as voxels() does, memory-mapping
+        the file for as long as the blocks are being generated.
+        """
+        with open(filename, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for voxel in Blueprint.voxels(buf, chunk_size):
+                    yield voxel
+            finally:
+                buf.close()
+
+    def positions(self):
+        """
+        Generate the coordinates of every block, in the order of the block records.
+        """
+        return bitmask_positions(self.bitmask, self.length, self.width)
+
+    def block(self, i):
+        """
+        Return the (type, rotation, unknown, shape) bytes of the i'th block record.
+        """
+        return struct.unpack("BBBB", self.blocks[4 * i:4 * i + 4])
+
+
+def verify_bp(buf, chunk_size=1 << 20):
+    """
+    Re-decode a blueprint held in a string or mmap, inflating and checking the block
+    data one chunk at a time, and check that it is self-consistent: the zip entry is
+    intact, the header bitmask is sized for the dimensions, the block codes are
+    known, and the block data is laid out as generate_blocks() writes it, with a
+    block record for every set bit followed by a marker and four footer sections the
+    size of the header. Returns a list of the problems found, which is empty for a
+    valid blueprint.
+    """
+    zip_start = buf.rfind(BP_ZIP_MARKER)
+    if zip_start < 21:
+        return ["No zip section found in blueprint."]
+    length, width, height = struct.unpack("<LLL", buf[9:21])
+    size = bp_zip_entry_size(buf, zip_start)
+
+    problems = []
+    n_cells = length * width * height
+    if n_cells == 0:
+        problems.append("Blueprint has zero size: %d %d %d" % (length, width, height))
+
+    stream = ChunkReader(inflate_bp_zip_entry(buf, zip_start, chunk_size))
+    try:
+        data = stream.read(4)
+        if len(data) != 4:
+            return problems + ["Blueprint block data is truncated before the header."]
+        n_hdr_bytes = struct.unpack("<L", data)[0]
+        bitmask = stream.read(n_hdr_bytes)
+        if len(bitmask) != n_hdr_bytes:
+            return problems + ["Blueprint block data is truncated in the header."]
+
+        if n_hdr_bytes != int(math.ceil(n_cells / 8.0)):
+            problems.append("Header has %d bytes, expected %d for dimensions "
+                            "%d %d %d" % (n_hdr_bytes, int(math.ceil(n_cells / 8.0)),
+                                          length, width, height))
+        elif n_cells % 8 != 0 and ord(bitmask[-1]) >> (n_cells % 8) != 0:
+            problems.append("Header has bits set beyond the blueprint dimensions")
+        n_blocks = sum([BIT_COUNTS[b] for b in bytearray(bitmask)])
+
+        # Every set bit has a 4-byte record, and the footer is a marker followed by
+        # four sections the same size as the header. Any other size means records
+        # are missing or extra, whatever the bytes after them happen to be.
+        footer_size = 2 + 4 * (4 + n_hdr_bytes)
+        expected_size = 4 + n_hdr_bytes + 4 * n_blocks + footer_size
+        if size != expected_size:
+            problems.append("%d block records expected, %s %d bytes" % (
+                n_blocks, "extra" if size > expected_size else "missing",
+                abs(size - expected_size)))
+            stream.skip(size)
+            return problems
+
+        shapes = set(BLOCK_TYPE_MAPPING.values())
+        bad_blocks = 0
+        for i in xrange(0, n_blocks, chunk_size // 4):
+            records = bytearray(stream.read(4 * min(chunk_size // 4, n_blocks - i)))
+            bad_blocks += len([
+                j for j in xrange(0, len(records), 4)
+                if records[j + 3] not in shapes or
+                (records[j + 1] != 1 and records[j + 1] not in SLOPE_CODE_MAPPING)
+            ])
+        if bad_blocks > 0:
+            problems.append("%d block records have unknown shape or rotation codes" %
+                            bad_blocks)
+
+        if stream.read(2) != "\x01\x7f":
+            problems.append("Footer does not start with the section marker")
+        for i in range(4):
+            section_size = struct.unpack("<L", stream.read(4))[0]
+            if section_size != n_hdr_bytes:
+                problems.append("Footer section %d has %d bytes, expected %d" %
+                                (i, section_size, n_hdr_bytes))
+                break
+            stream.skip(section_size)
+        # Reaching the end of the stream checks the CRC.
+        stream.skip(size)
+    except (ValueError, struct.error, zlib.error) as e:
+        problems.append(str(e))
+
+    return problems
+
+
+def verify_bp_file(filename):
+    """
+    Verify a blueprint file with verify_bp(), memory-mapping it rather than reading
+    it. Returns the filename and the list of problems found.
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return (filename, verify_bp(buf))
+            finally:
+                buf.close()
+    except (IOError, ValueError) as e:
+        # Empty files cannot be memory-mapped.
+        return (filename, [str(e)])
+
+
+class SlabStore(object):
+    """
+    A collection of records whose first three fields are integer coordinates, spilled
+    to disk in slabs of a fixed thickness along the third coordinate. Each slab is a
+    file of fixed-size binary records, which compact() sorts and deduplicates, so at
+    most a handful of slabs need to be held in memory at once.
+    """
+
+    def __init__(self, thickness, record_format="<lll", directory=None,
+                 buffer_size=65536):
+        self.thickness = thickness
+        self.record = struct.Struct(record_format)
+        self.directory = tempfile.mkdtemp(prefix="egs-", dir=directory)
+        self.buffer_size = buffer_size
+        self.buffers = dict()
+        self.n_buffered = 0
+        self.slabs = set()
+
+    def slab_path(self, slab):
+        return os.path.join(self.directory, "%d.slab" % slab)
+
+    def add(self, records):
+        """
+        Add records to the store, spilling them to disk when enough are buffered.
+        """
+        for r in records:
+            self.buffers.setdefault(r[2] // self.thickness, []).append(r)
+            self.n_buffered += 1
+        if self.n_buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Append all buffered records to their slab files.
+        """
+        for slab, records in self.buffers.iteritems():
+            with open(self.slab_path(slab), 'ab') as fp:
+                fp.write("".join([self.record.pack(*r) for r in records]))
+            self.slabs.add(slab)
+        self.buffers = dict()
+        self.n_buffered = 0
+
+    def read(self, slab):
+        """
+        Read all records in a single slab.
+        """
+        if slab not in self.slabs:
+            return []
+        with open(self.slab_path(slab), 'rb') as fp:
+            data = fp.read()
+        return [
+            self.record.unpack_from(data, i)
+            for i in xrange(0, len(data), self.record.size)
+        ]
+
+    def read_range(self, zmin, zmax):
+        """
+        Read all records with a third coordinate in the inclusive range given.
+        """
+        return [
+            r for slab in xrange(zmin // self.thickness, zmax // self.thickness + 1)
+            for r in self.read(slab) if zmin <= r[2] <= zmax
+        ]
+
+    def compact(self):
+        """
+        Rewrite every slab with its records deduplicated, and sorted in the order
+        the blueprint bitmask is laid out in (third, second, then first coordinate).
+        """
+        self.flush()
+        for slab in self.slabs:
+            records = sorted(set(self.read(slab)), key=BLUEPRINT_ORDER)
+            with open(self.slab_path(slab), 'wb') as fp:
+                fp.write("".join([self.record.pack(*r) for r in records]))
+
+    def __len__(self):
+        return sum([
+            os.path.getsize(self.slab_path(slab)) / self.record.size
+            for slab in self.slabs
+        ])
+
+    def bounds(self):
+        """
+        Find the minimal and maximal coordinates of all records, one slab at a time.
+        """
+        m = None
+        M = None
+        for slab in sorted(self.slabs):
+            positions = [r[:3] for r in self.read(slab)]
+            if len(positions) == 0:
+                continue
+            sm, sM = bounding_box(positions)
+            m = sm if m is None else [min(a, b) for a, b in zip(m, sm)]
+            M = sM if M is None else [max(a, b) for a, b in zip(M, sM)]
+        return (m, M)
+
+    def close(self):
+        shutil.rmtree(self.directory, True)
+
+
+def out_of_core_split_tris(Primitives, Resolution, store, BatchSize=100):
+    """
+    Split the triangles to the given resolution, spilling each batch of points into
+    the given SlabStore.
+    """
+    for i in xrange(0, len(Primitives), BatchSize):
+        pts = set()
+        midpoints = dict()
+        for p in Primitives[i:i + BatchSize]:
+            pts.update(tri_voxels(p, Resolution, midpoints))
+        store.add(pts)
+    store.compact()
+    return store
+
+
+def out_of_core_stage(src, dst, halo, func):
+    """
+    Apply func to every slab of src, along with halo units of the neighbouring slabs
+    on either side, and keep only the records func returns that lie in that slab.
+    The halo must be at least as large as the distance over which func looks for,
+    or adds, records.
+    """
+    if len(src.slabs) == 0:
+        return dst
+
+    reach = int(math.ceil(1.0 * halo / src.thickness))
+    start_time = time.time()
+    slabs = range(min(src.slabs) - reach, max(src.slabs) + reach + 1)
+    for n, slab in enumerate(slabs):
+        z0 = slab * src.thickness
+        z1 = z0 + src.thickness - 1
+        records = src.read_range(z0 - halo, z1 + halo)
+        if len(records) > 0:
+            dst.add([r for r in func(records) if z0 <= r[2] <= z1])
+        sys.stderr.write("Slab %d/%d (ETA: %f)\n" % (
+            n + 1,
+            len(slabs),
+            (len(slabs) - n - 1) * (time.time() - start_time) / (n + 1)
+        ))
+    dst.compact()
+    return dst
+
+
+def out_of_core_smooth(src, dst, aggressive=False, corners=False):
+    """
+    Smooth the points of a SlabStore into a SlabStore of (x, y, z, shape, rotation)
+    records, filling in corners as well if asked. The slabs are swept in order, and
+    the slopes placed in each are carried into the next, so the points are visited
+    in the same order as smooth_pts() visits them, and the blocks are exactly those
+    that smooth_pts() and fill_corners() give for the whole model.
+    """
+    if len(src.slabs) == 0:
+        return dst
+
+    # Smoothing looks, and places slopes, up to three blocks away from each point, so
+    # the blocks more than three below the next point to visit are final. Corners are
+    # placed up to two blocks from the slopes that form them, so the final blocks
+    # are held until the corners among them are known.
+    pts = dict()
+    smoothed = dict()
+    written = [None]
+
+    def finish(final):
+        for p in [p for p in pts if p[2] <= final]:
+            block = pts.pop(p)
+            if block is not None:
+                smoothed[p] = block
+        last = final - 2 if corners else final
+        blocks = fill_corners(dict(smoothed)) if corners else smoothed
+        dst.add(map_to_empyrion_codes(dict([
+            (p, b) for p, b in blocks.iteritems()
+            if p[2] <= last and (written[0] is None or p[2] > written[0])
+        ])))
+        for p in [p for p in smoothed if p[2] < last - 1]:
+            del smoothed[p]
+        written[0] = last
+
+    start_time = time.time()
+    slabs = range(min(src.slabs), max(src.slabs) + 1)
+    for n, slab in enumerate(slabs):
+        z0 = slab * src.thickness
+        z1 = z0 + src.thickness - 1
+        for r in src.read_range(z0, z1 + 3):
+            pts[r] = 0
+        smooth_in_order(src.read(slab), pts, aggressive)
+        finish(z1 - 3)
+        sys.stderr.write("Slab %d/%d (ETA: %f)\n" % (
+            n + 1,
+            len(slabs),
+            (len(slabs) - n - 1) * (time.time() - start_time) / (n + 1)
+        ))
+    finish(slabs[-1] * src.thickness + src.thickness + 3)
+
+    dst.compact()
+    return dst
+
+
+def out_of_core_generate_blocks(store, fp, block_type="\x87"):
+    """
+    Write the blocks in the store, whose records are (x, y, z, shape, rotation), to
+    the file in the same format as generate_blocks(), streaming one slab at a time.
+    """
+    m, M = store.bounds()
+    if m is None:
+        raise ValueError("There are no blocks to write.")
+    length, width, height = list_subtract(M, m)
+    length += 1
+    width += 1
+    height += 1
+    sys.stderr.write("Dimensions of resulting blueprint: %d %d %d\n" %
+                     (length, width, height))
+
+    n_hdr_bytes = int(math.ceil(length * width * height / 8.0))
+    sys.stderr.write("Model requires %d header bytes\n" % n_hdr_bytes)
+    fp.write(struct.pack("<L", n_hdr_bytes))
+
+    def write_zeros(n):
+        while n > 0:
+            fp.write("\x00" * min(n, 1 << 20))
+            n -= 1 << 20
+
+    # The records in each slab are sorted in the same order as the bits of the
+    # header, so the bitmask is written with one pass over the slabs, filling the
+    # gaps between set bits with zero bytes.
+    cur_byte = 0
+    cur_mask = 0
+    set_bits = 0
+    for slab in sorted(store.slabs):
+        for r in store.read(slab):
+            bit = ((r[2] - m[2]) * width + (r[1] - m[1])) * length + (r[0] - m[0])
+            if bit >> 3 != cur_byte:
+                fp.write(chr(cur_mask))
+                write_zeros((bit >> 3) - cur_byte - 1)
+                cur_byte = bit >> 3
+                cur_mask = 0
+            cur_mask |= 1 << (bit & 7)
+            set_bits += 1
+    fp.write(chr(cur_mask))
+    write_zeros(n_hdr_bytes - cur_byte - 1)
+    sys.stderr.write("%d bits set in header bytes for %d blocks.\n" %
+                     (set_bits, len(store)))
+
+    # The block strings follow in the same order.
+    for slab in sorted(store.slabs):
+        fp.write("".join([
+            block_type + chr(r[4]) + chr(0) + chr(r[3]) for r in store.read(slab)
+        ]))
+
+    fp.write("\x01\x7f")
+    for _ in xrange(4):
+        fp.write(struct.pack("<L", n_hdr_bytes))
+        write_zeros(n_hdr_bytes)
+
+    return (length, width, height)
+
+
+def out_of_core_build_new_bp(bp_body, store, bp_class, block_type='Steel-Small',
+                             report_sections=False):
+    """
+    Build a blueprint from a SlabStore of (x, y, z, shape, rotation) records, staging
+    the uncompressed block data on disk rather than in memory. The section sizes are
+    reported as build_new_bp() does.
+    """
+    blocks_path = os.path.join(store.directory, "0")
+    with open(blocks_path, 'wb') as fp:
+        length, width, height = out_of_core_generate_blocks(
+            store, fp, BLOCK_TYPE_CODES[block_type])
+    if report_sections:
+        with open(blocks_path, 'rb') as fp:
+            report_bp_section_sizes(bp_section_sizes(fp, len(store)))
+
+    sso = StringIO.StringIO()
+    zf = zipfile.ZipFile(sso, 'w', zipfile.ZIP_DEFLATED)
+    zf.write(blocks_path, '0')
+    zf.close()
+    os.remove(blocks_path)
+
+    return assemble_bp(bp_body, sso, bp_class, length, width, height)
@@ -5,10 +5,14 @@ or a Lambda event body, and performs the necessary functions.
 """
 
 import sys
+import gzip
 import json
+import zlib
+import math
 import time
 import base64
 import urllib2
+import zipfile
 import StringIO
 import threading
 
@@ -36,6 +40,18 @@ def lambda_handler(event, _):
     Given a Lambda event body, ready the STL file and generate a new blueprint
     based on the parameters.
     """
+    if event.get('ResponseCompression', None) is not None:
+        uncompressed_event = dict(event)
+        del uncompressed_event['ResponseCompression']
+        return compress_response(lambda_handler(uncompressed_event, None),
+                                 event['ResponseCompression'])
+    if event.get('BlockBudget', None) is not None:
+        return fit_block_budget(event, event['BlockBudget'])
+    if event.get('OrientationSweep', False):
+        return orientation_sweep(event)
+    if event.get('Estimate', False):
+        return estimate_run(event)
+
     operation_start = time.time()
     stl_body = base64.b64decode(event['STLBody'])
     disable_smoothing = event.get('DisableSmoothing', False)
@@ -50,61 +66,152 @@ def lambda_handler(event, _):
     hollow_radius = event.get('HollowRadius', None)
     flood_hollow = event.get('FloodHollow', False)
     no_multithreading = event.get('NoMultithreading', False)
+    tiled_splitting = event.get('TiledSplitting', False)
+    tile_size = event.get('TileSize', None)
+    closing_tile_size = event.get('ClosingTileSize', None)
+    out_of_core = event.get('OutOfCore', False)
+    tile_budget = event.get('TileBudget', 2**24)
+    verify_blueprint = event.get('VerifyBlueprint', False)
+    block_type = event.get('BlockType', 'Steel-Small')
+    symmetric = event.get('Symmetric', False)
+    frontier_morphology = event.get('FrontierMorphology', False)
+    solid_fill = event.get('SolidFill', False)
+    bitset_morphology = event.get('BitsetMorphology', False)
+    weld = event.get('Weld', False)
+    weld_tolerance = event.get('WeldTolerance', None)
+    decimate = event.get('Decimate', None)
+    disable_decimation_check = event.get('DisableDecimationCheck', False)
+
+    if out_of_core:
+        # The out-of-core pipeline only holds a few slabs of the model at a time, so
+        # the stages that need the whole model, or whole clouds, are not available.
+        unsupported = [name for name, value in (
+            ('FloodHollow', flood_hollow), ('SolidFill', solid_fill),
+            ('Symmetric', symmetric), ('FrontierMorphology', frontier_morphology),
+            ('BitsetMorphology', bitset_morphology)) if value]
+        if len(unsupported) > 0:
+            raise ValueError("OutOfCore cannot be combined with %s." %
+                             ", ".join(unsupported))
 
     with open('BlueprintBase/BlueprintBase.epb', 'r') as fp:
         bp_body = fp.read()
 
-    ssi = StringIO.StringIO(stl_body)
+    ssi = stl_file(stl_body)
     timer_start = time.time()
     triangles = empyrion.STLFile.read_triangles(ssi)
     sys.stderr.write("Reading model took %s seconds.\n" %
                      str(time.time() - timer_start))
     sys.stderr.write("Model has %d triangles\n" % len(triangles))
 
+    mesh = None
+    if len(triangles) > 0 and weld:
+        # Weld the triangle soup into an indexed mesh, so that every vertex is stored
+        # once, and drop the triangles that would only waste time in splitting.
+        timer_start = time.time()
+        if weld_tolerance is None:
+            weld_tolerance = empyrion.mesh_weld_tolerance(triangles)
+        mesh, report = empyrion.IndexedMesh.weld(triangles, weld_tolerance)
+        triangles = mesh.triangles()
+        sys.stderr.write("Welded %d vertices into %d (tolerance %g), and removed %d "
+                         "collapsed, %d zero-area and %d duplicate triangles in %s "
+                         "seconds.\n" %
+                         (report['vertices_in'], report['vertices'], weld_tolerance,
+                          report['collapsed'], report['degenerate'],
+                          report['duplicate'], str(time.time() - timer_start)))
+
     if len(triangles) == 0:
         return ""
 
     bounds = empyrion.triangle_list_bounds(triangles)
     sys.stderr.write("Model bounds: %s\n" % str(bounds))
 
+    resolution = model_resolution(bounds, voxel_dimension)
+
+    decimation_sample = None
+    if decimate is not None:
+        # Collapse the mesh by vertex clustering on a grid of the given fraction of a
+        # block, so that detail too fine to be seen in blocks is not split.
+        timer_start = time.time()
+        if mesh is None:
+            mesh, _ = empyrion.IndexedMesh.weld(triangles)
+        if not disable_decimation_check:
+            # The sample is checked against the voxels of the decimated model once
+            # they are split, so it is transformed along with the model.
+            step = max(1, int(round(1.0 / DECIMATION_CHECK_FRACTION)))
+            decimation_sample = triangles[::step]
+        mesh, report = mesh.cluster(decimate * resolution)
+        triangles = mesh.triangles()
+        sys.stderr.write("Decimated %d triangles and %d vertices into %d triangles and "
+                         "%d vertices in %s seconds.\n" %
+                         (report['faces_in'], report['vertices_in'], len(triangles),
+                          report['vertices'], str(time.time() - timer_start)))
+
     # To assist with ensuring symmetry, shift the points so that the centroid
     # of the model is at the origin. Find the midpoint along each of dimensions
     # of the cube spanned by the bounds of the model, and subtract that midpoint
     # from each triangle coordinate.
+    #
+    # The shift is fused with the dimension remapping and mirroring, so that the
+    # triangles are transformed in a single pass before they are split, rather than
+    # transforming every point afterwards.
+    timer_start = time.time()
     origin_offset = [-sum(b) / 2 for b in bounds]
-    for t in triangles:
-        t.shift(origin_offset)
+    transform = empyrion.AxisTransform.from_options(dim_remap, dim_mirror,
+                                                    origin_offset)
+    triangles = transform.triangles(triangles)
+    if decimation_sample is not None:
+        decimation_sample = transform.triangles(decimation_sample)
+    sys.stderr.write("Model transformation took %s seconds.\n" %
+                     str(time.time() - timer_start))
 
-    # For clarity, show the transposed model bounds, which should be symmetric.
+    # For clarity, show the transformed model bounds, which should be symmetric.
     bounds = empyrion.triangle_list_bounds(triangles)
-    sys.stderr.write("Translated model bounds: %s\n" % str(bounds))
+    sys.stderr.write("Transformed model bounds: %s\n" % str(bounds))
 
-    if reflect is not None:
+    # In the symmetric pipeline, only the half of the model on the non-negative side
+    # of the reflection plane is voxelized and processed, and the blocks are mirrored
+    # at the end. The out-of-core pipeline always processes the whole model.
+    if reflect is not None and symmetric and not out_of_core:
+        symmetric_dim = transform.dimension(reflect)
+    else:
+        symmetric_dim = None
+
+    if reflect is not None and symmetric_dim is None:
         # If the reflection dimension is given, then duplicate all triangle, so that
-        # each triangle has a twin that is reflected in the given dimension.
+        # each triangle has a twin that is reflected in the given dimension. The
+        # dimension is given before remapping.
         duped_tris = []
         for tri in triangles:
             duped_tris.append(tri)
-            duped_tris.append(tri.reflect(reflect))
+            duped_tris.append(tri.reflect(transform.dimension(reflect)))
         sys.stderr.write("Reflected all triangles: %d -> %d\n" %
                          (len(triangles), len(duped_tris)))
         triangles = duped_tris
 
-    # First, see if the voxel_dimension is a list, and if it isn't use the
-    # longest dimension.
-    if isinstance(voxel_dimension, list):
-        dim, size = voxel_dimension
-        resolution = (bounds[dim - 1][1] - bounds[dim - 1][0]) / (size - 1)
-    else:
-        longest_dim = max([i[1] - i[0] for i in bounds])
-        resolution = longest_dim / (abs(voxel_dimension) - 1)
-
     sys.stderr.write("Computed spatial resolution in model-space: %f\n" %
                      resolution)
 
+    if out_of_core:
+        new_bp = out_of_core_pipeline(
+            triangles, bounds, resolution, bp_body, bp_class,
+            morphological_factors, hollow_radius, disable_smoothing,
+            aggressive_smoothing, corner_blocks, tile_budget, block_type,
+            verify_blueprint, decimation_sample)
+        if not new_bp:
+            return ""
+        if verify_blueprint:
+            verify_new_bp(new_bp)
+        sys.stderr.write("Resulting blueprint size: %d bytes\n" % len(new_bp))
+        sys.stderr.write("Voxelization operation took %s seconds.\n" %
+                         str(time.time() - operation_start))
+        return base64.b64encode(new_bp)
+
     sys.stderr.write("Splitting triangles...\n")
     timer_start = time.time()
-    if empyrion.parallel() and not no_multithreading:
+    if empyrion.parallel() and not no_multithreading and tiled_splitting:
+        pts = empyrion.parallel_tiled_split_tris(triangles, resolution,
+                                                 tile_size)
+    elif empyrion.parallel() and not no_multithreading:
         pts = empyrion.parallel_split_tris(triangles, resolution)
     else:
         pts = empyrion.split_tris(triangles, resolution)
@@ -113,61 +220,85 @@ def lambda_handler(event, _):
     sys.stderr.write("Split %d triangles into %d points.\n" %
                      (len(triangles), len(pts)))
 
-    # Mirror the dimensions listed. For each dimension, just negate the coordinates
-    # of all points in that dimension
-    timer_start = time.time()
-    pts = [tuple([p[dim_remap[i] - 1] for i in range(3)]) for p in pts]
-    tuple_mul = lambda t1, t2: (t1[0] * t2[0], t1[1] * t2[1], t1[2] * t2[2])
-    dim_mirror_tuple = [-1 if i + 1 in dim_mirror else 1 for i in range(3)]
-    pts = [tuple_mul(dim_mirror_tuple, p) for p in pts]
-    sys.stderr.write("Dimension mirroring and remapping took %s seconds.\n" %
-                     str(time.time() - timer_start))
+    if decimation_sample is not None:
+        verify_decimated_mesh(decimation_sample, pts, resolution)
 
-    if morphological_factors is not None:
-        sys.stderr.write("Dilating voxel cloud...\n")
+    if solid_fill:
         timer_start = time.time()
-        if empyrion.parallel() and not no_multithreading:
-            pts = empyrion.parallel_morphological_dilate(
-                pts, morphological_factors[0])
-        else:
-            pts = empyrion.morphological_dilate(pts, morphological_factors[0])
-        sys.stderr.write("Morphological dilation took %s seconds.\n" %
-                         str(time.time() - timer_start))
-        sys.stderr.write("Morphological dilation expanded to %d points.\n" %
-                         len(pts))
+        fill_triangles = triangles
+        if symmetric_dim is not None:
+            # The half model is only closed once its reflection is added back.
+            fill_triangles = triangles + [tri.reflect(symmetric_dim)
+                                          for tri in triangles]
+        surface = set(pts)
+        pts = surface | empyrion.solid_fill(fill_triangles, resolution)
+        sys.stderr.write("Solid filling added %d interior points in %s seconds.\n" %
+                         (len(pts) - len(surface), str(time.time() - timer_start)))
 
-        sys.stderr.write("Eroding voxel cloud...\n")
+    if symmetric_dim is not None:
+        pts = empyrion.fold_points(pts, symmetric_dim)
+        sys.stderr.write("Folded the voxel cloud into %d points on one side of the "
+                         "reflection plane.\n" % len(pts))
+
+    if morphological_factors is not None:
+        sys.stderr.write("Closing voxel cloud...\n")
         timer_start = time.time()
-        if empyrion.parallel() and not no_multithreading:
-            pts = empyrion.parallel_morphological_erode(
-                pts, morphological_factors[1])
+        if bitset_morphology:
+            close = lambda q: empyrion.bitset_close(
+                q, morphological_factors[0], morphological_factors[1])
+        elif empyrion.parallel() and not no_multithreading:
+            close = lambda q: empyrion.parallel_morphological_close(
+                q, morphological_factors[0], morphological_factors[1],
+                closing_tile_size, frontier_morphology)
         else:
-            pts = empyrion.morphological_erode(pts, morphological_factors[1])
-        sys.stderr.write("Morphological erosion took %s seconds.\n" %
+            close = lambda q: empyrion.morphological_close(
+                q, morphological_factors[0], morphological_factors[1],
+                closing_tile_size, frontier_morphology)
+        pts = empyrion.symmetric_apply(pts, symmetric_dim,
+                                       sum(morphological_factors), close)
+        sys.stderr.write("Morphological closing took %s seconds.\n" %
                          str(time.time() - timer_start))
-        sys.stderr.write("Morphological erosion reduced to %d points.\n" %
+        sys.stderr.write("Morphological closing produced %d points.\n" %
                          len(pts))
 
     if flood_hollow:
         timer_start = time.time()
-        m, M = empyrion.bounding_box(pts)
-        length, width, height = empyrion.list_subtract(M, m)
-        length += 1
-        width += 1
-        height += 1
-        positions = [tuple(empyrion.list_subtract(p, m)) for p in pts]
-        dbm = empyrion.sparse_to_dense(positions, [(0, 1) for _ in range(len(positions))],
-                                       length, width, height)
-        sys.stderr.write("Performing flood-fill hollowing pass 1 (Removing interior cubes).\n")
-        n_positions = len(positions)
-        _, pts = empyrion.flood_hollow_dbm(dbm, positions)
+        # The flood needs to start from outside the whole model, so it is performed
+        # on the whole symmetric cloud.
+        if symmetric_dim is not None:
+            pts = empyrion.mirror_blocks(dict.fromkeys(pts, 0),
+                                         symmetric_dim).keys()
+        n_positions = len(pts)
+        if bitset_morphology:
+            sys.stderr.write("Performing flood-fill hollowing on bitmask columns.\n")
+            pts = empyrion.bitset_flood_hollow(pts)
+        else:
+            m, M = empyrion.bounding_box(pts)
+            length, width, height = empyrion.list_subtract(M, m)
+            length += 1
+            width += 1
+            height += 1
+            positions = [tuple(empyrion.list_subtract(p, m)) for p in pts]
+            dbm = empyrion.sparse_to_dense(positions,
+                                           [(0, 1) for _ in range(len(positions))],
+                                           length, width, height)
+            sys.stderr.write("Performing flood-fill hollowing pass 1 (Removing interior cubes).\n")
+            _, pts = empyrion.flood_hollow_dbm(dbm, positions)
+            if symmetric_dim is not None:
+                # Shift back so the reflection plane passes through the origin again.
+                pts = [tuple(empyrion.list_subtract(p, [-c for c in m])) for p in pts]
+        if symmetric_dim is not None:
+            pts = [p for p in pts if p[symmetric_dim - 1] >= 0]
         sys.stderr.write("Flood-hollowing reduced from %d to %d blocks in %f seconds.\n" % (
             n_positions, len(pts), time.time() - timer_start))
 
     if not disable_smoothing:
         sys.stderr.write("Smoothing voxel cloud...\n")
         timer_start = time.time()
-        smoothed_pts = empyrion.smooth_pts(pts, aggressive_smoothing)
+        # Slopes are placed up to three blocks away from the voxels they start from.
+        smoothed_pts = empyrion.symmetric_apply(
+            pts, symmetric_dim, 3,
+            lambda q: empyrion.smooth_pts(q, aggressive_smoothing))
         sys.stderr.write("Voxel smoothing took %s seconds.\n" %
                          str(time.time() - timer_start))
         sys.stderr.write("Smoothed %d voxels into %d blocks.\n" %
@@ -175,35 +306,36 @@ def lambda_handler(event, _):
     else:
         # Otherwise naively convert the list of coordinates into a mapping to
         # all cubes.
-        smoothed_pts = dict([(p, 0) for p in pts])
+        smoothed_pts = dict.fromkeys(pts, 0)
 
     if corner_blocks:
         timer_start = time.time()
         pre_corner_count = len(smoothed_pts)
-        smoothed_pts = empyrion.fill_corners(smoothed_pts)
+        # Corners are placed at most two blocks from the slopes that form them.
+        smoothed_pts = empyrion.symmetric_apply(smoothed_pts, symmetric_dim, 2,
+                                                empyrion.fill_corners)
         sys.stderr.write("Filled in %d corner blocks in %s seconds.\n" %
                          (len(smoothed_pts) - pre_corner_count,
                           str(time.time() - timer_start)))
 
     if hollow_radius is not None:
-        sys.stderr.write("Hollowing voxel cloud...\n")
-        timer_start = time.time()
-        if empyrion.parallel() and not no_multithreading:
-            passing_blocks = empyrion.hollow(smoothed_pts.keys(),
-                                             hollow_radius)
-        else:
-            passing_blocks = empyrion.hollow(smoothed_pts, hollow_radius)
-        # The passing blocks are all of the block coordinates we should keep
-        smoothed_pts = dict([(c, smoothed_pts[c]) for c in passing_blocks])
-        sys.stderr.write("Model hollowing took %s seconds.\n" %
-                         str(time.time() - timer_start))
-        sys.stderr.write("Hollowed down to %d blocks.\n" % len(smoothed_pts))
+        smoothed_pts = hollow_pts(smoothed_pts, hollow_radius, symmetric_dim,
+                                  frontier_morphology, bitset_morphology,
+                                  no_multithreading)
+
+    if symmetric_dim is not None:
+        # The stages above are performed on the half model, which is mirrored last.
+        smoothed_pts = empyrion.mirror_blocks(smoothed_pts, symmetric_dim)
+        sys.stderr.write("Mirrored the model into %d blocks.\n" % len(smoothed_pts))
 
     timer_start = time.time()
     mapped_blocks = empyrion.map_to_empyrion_codes(smoothed_pts)
-    new_bp = empyrion.build_new_bp(bp_body, mapped_blocks, bp_class, flood_hollow)
+    new_bp = empyrion.build_new_bp(bp_body, mapped_blocks, bp_class, flood_hollow,
+                                   block_type, verify_blueprint)
     sys.stderr.write("Blueprint generation took %s seconds.\n" %
                      str(time.time() - timer_start))
+    if verify_blueprint:
+        verify_new_bp(new_bp)
     sys.stderr.write("Resulting blueprint size: %d bytes\n" % len(new_bp))
     sys.stderr.write("Voxelization operation took %s seconds.\n" %
                      str(time.time() - operation_start))
@@ -211,6 +343,620 @@ def lambda_handler(event, _):
     return base64.b64encode(new_bp)
 
 
+def stl_file(stl_body):
+    """
+    Return a file object for reading the STL file from the request body. Bodies
+    compressed with gzip or zlib, recognised by their magic bytes, are decompressed
+    as they are read.
+    """
+    wbits = empyrion.compression_wbits(stl_body)
+    if wbits is None:
+        return StringIO.StringIO(stl_body)
+    sys.stderr.write("Decompressing %s compressed model of %d bytes.\n" %
+                     ("gzip" if wbits > zlib.MAX_WBITS else "zlib", len(stl_body)))
+    return empyrion.InflatingReader(StringIO.StringIO(stl_body), wbits)
+
+
+def compress_response(encoded, method):
+    """
+    Compress a base64 encoded blueprint with gzip or zlib (HTTP deflate), and return
+    it base64 encoded again.
+    """
+    if not encoded:
+        return encoded
+    data = base64.b64decode(encoded)
+    if method == 'gzip':
+        sso = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=sso, mode='wb', mtime=0) as gz:
+            gz.write(data)
+        compressed = sso.getvalue()
+    elif method == 'deflate':
+        compressed = zlib.compress(data)
+    else:
+        raise ValueError("Unknown response compression: %s" % method)
+    sys.stderr.write("Compressed the response from %d to %d bytes with %s.\n" %
+                     (len(data), len(compressed), method))
+    return base64.b64encode(compressed)
+
+
+def model_resolution(bounds, voxel_dimension):
+    """
+    Return the spatial resolution in model-space for the blueprint size, which is
+    either the number of blocks on the longest dimension of the model, or a
+    [dimension, size] pair giving the number of blocks on that dimension.
+    """
+    if isinstance(voxel_dimension, list):
+        dim, size = voxel_dimension
+        return (bounds[dim - 1][1] - bounds[dim - 1][0]) / (size - 1)
+    longest_dim = max([i[1] - i[0] for i in bounds])
+    return longest_dim / (abs(voxel_dimension) - 1)
+
+
+# The estimate-only mode splits patches of the triangles, made of the triangles in
+# tiles of this many voxels on a side, covering about this fraction of the surface.
+ESTIMATE_TILE_SIZE = 16
+ESTIMATE_SAMPLE_FRACTION = 0.1
+# The bytes used for each vertex held while a batch of triangles is split, including
+# the edge midpoint cache, as measured with CPython 2.7 on 64 bit Linux.
+SPLIT_VERTEX_BYTES = 500
+# The number of triangles split together by split_tris().
+SPLIT_BATCH_SIZE = 100
+
+
+def estimate_run(event):
+    """
+    Estimate the point count, block count, peak memory and time of each stage of a
+    run, without performing it. The model is decimated and reflected in full, then
+    only patches of the triangles are split, closed, smoothed, given corners and
+    hollowed, and the results are scaled up by the fraction of the surface area
+    that the patches cover. The blueprint dimensions, and so the size of the dense
+    matrices built in generate_blocks() and for flood-fill hollowing, follow from
+    the model bounds. The patches are open, so flood-fill hollowing removes none of
+    their blocks, and the block count is an upper bound for it. A symmetric run is
+    estimated as the run with the whole model reflected. The times are for a single
+    process, and the memory excludes the interpreter itself. Return the estimate as
+    JSON.
+    """
+    # The interior that solid filling adds is a volume, which does not scale with the
+    # surface area of the patches, and out-of-core runs hold their points on disk.
+    unsupported = [name for name in ('SolidFill', 'OutOfCore') if event.get(name)]
+    if len(unsupported) > 0:
+        raise ValueError("An estimate cannot be made with %s." %
+                         ", ".join(unsupported))
+
+    operation_start = time.time()
+    stl_body = base64.b64decode(event['STLBody'])
+    voxel_dimension = event.get('BlueprintSize', 25)
+    disable_smoothing = event.get('DisableSmoothing', False)
+    aggressive_smoothing = event.get('AggressiveSmoothing', False)
+    reflect = event.get('Reflect', None)
+    corner_blocks = event.get('CornerBlocks', False)
+    morphological_factors = event.get('MorphologicalFactors', None)
+    hollow_radius = event.get('HollowRadius', None)
+    flood_hollow = event.get('FloodHollow', False)
+    frontier_morphology = event.get('FrontierMorphology', False)
+    bitset_morphology = event.get('BitsetMorphology', False)
+    weld = event.get('Weld', False)
+    weld_tolerance = event.get('WeldTolerance', None)
+    decimate = event.get('Decimate', None)
+
+    seconds = dict()
+
+    # Reading, and welding if asked for, are performed in full, and the memory peaks
+    # while the triangles read are welded.
+    timer_start = time.time()
+    triangles = empyrion.STLFile.read_triangles(stl_file(stl_body))
+    seconds['reading'] = time.time() - timer_start
+    body_bytes = len(event['STLBody']) + len(stl_body)
+    read_bytes = body_bytes + empyrion.mesh_size(triangles)
+    mesh = None
+    if len(triangles) > 0 and weld:
+        timer_start = time.time()
+        if weld_tolerance is None:
+            weld_tolerance = empyrion.mesh_weld_tolerance(triangles)
+        mesh = empyrion.IndexedMesh.weld(triangles, weld_tolerance)[0]
+        triangles = mesh.triangles()
+        seconds['welding'] = time.time() - timer_start
+    if len(triangles) == 0:
+        return ""
+    bounds = empyrion.triangle_list_bounds(triangles)
+    resolution = model_resolution(bounds, voxel_dimension)
+    if decimate is not None:
+        timer_start = time.time()
+        if mesh is None:
+            mesh = empyrion.IndexedMesh.weld(triangles)[0]
+        triangles = mesh.cluster(decimate * resolution)[0].triangles()
+        seconds['decimation'] = time.time() - timer_start
+    origin_offset = [-sum(b) / 2 for b in bounds]
+    triangles = empyrion.AxisTransform(origin_offset).triangles(triangles)
+    if reflect is not None:
+        # The model is not remapped, so the dimension is reflected as given.
+        triangles = triangles + [tri.reflect(reflect) for tri in triangles]
+    estimate = empyrion.mesh_statistics(triangles, resolution)
+    estimate['triangles'] = len(triangles)
+    estimate['resolution'] = resolution
+    mesh_bytes = body_bytes + empyrion.mesh_size(triangles)
+
+    # The model is only remapped, so the blueprint dimensions are those of the bounds,
+    # in some order.
+    dims = [int(round((b[1] - b[0]) / resolution)) + 1 for b in bounds]
+    estimate['dimensions'] = dims
+    estimate['dense_matrix_cells'] = dims[0] * dims[1] * dims[2]
+
+    sampled, fraction = empyrion.sample_triangles(triangles, resolution,
+                                                  ESTIMATE_TILE_SIZE,
+                                                  ESTIMATE_SAMPLE_FRACTION)
+    estimate['sample_fraction'] = fraction
+    scale = 1.0 / fraction
+
+    # The number of vertices each triangle splits into gives the memory held while a
+    # batch of triangles is split.
+    timer_start = time.time()
+    pts = set()
+    midpoints = dict()
+    n_vertices = 0
+    for tri in sampled:
+        small = empyrion.small_tri_voxels(tri, resolution)
+        if small is not None:
+            pts.update(small)
+            continue
+        vertices = empyrion.split_tri_vertices(tri, resolution, midpoints)
+        n_vertices += len(vertices)
+        pts.update(empyrion.round_vertices(vertices, resolution))
+    seconds['splitting'] = scale * (time.time() - timer_start)
+    estimate['points'] = int(scale * len(pts))
+    batch_vertices = min(SPLIT_BATCH_SIZE, len(triangles)) * n_vertices / len(sampled)
+    points_bytes = (scale * empyrion.approximate_size(pts) +
+                    batch_vertices * SPLIT_VERTEX_BYTES)
+
+    if morphological_factors is not None:
+        timer_start = time.time()
+        if bitset_morphology:
+            pts = empyrion.bitset_close(pts, morphological_factors[0],
+                                        morphological_factors[1])
+        else:
+            pts = empyrion.morphological_close(pts, morphological_factors[0],
+                                               morphological_factors[1], None,
+                                               frontier_morphology)
+        seconds['closing'] = scale * (time.time() - timer_start)
+        estimate['closed_points'] = int(scale * len(pts))
+        points_bytes = max(points_bytes, scale * empyrion.approximate_size(pts))
+
+    if flood_hollow:
+        # Flood-fill hollowing is dominated by its dense matrix, so its time is
+        # scaled by the number of cells, as generation is below.
+        timer_start = time.time()
+        m, M = empyrion.bounding_box(pts)
+        sample_dims = [b - a + 1 for a, b in zip(m, M)]
+        if bitset_morphology:
+            empyrion.bitset_flood_hollow(pts)
+        else:
+            positions = [tuple(empyrion.list_subtract(p, m)) for p in pts]
+            dbm = empyrion.sparse_to_dense(positions, [(0, 1)] * len(positions),
+                                           *sample_dims)
+            empyrion.flood_hollow_dbm(dbm, positions)
+        seconds['flood_hollowing'] = ((time.time() - timer_start) *
+                                      estimate['dense_matrix_cells'] /
+                                      (sample_dims[0] * sample_dims[1] *
+                                       sample_dims[2]))
+
+    if not disable_smoothing:
+        timer_start = time.time()
+        blocks = empyrion.smooth_pts(pts, aggressive_smoothing)
+        seconds['smoothing'] = scale * (time.time() - timer_start)
+    else:
+        blocks = dict.fromkeys(pts, 0)
+    if corner_blocks:
+        timer_start = time.time()
+        blocks = empyrion.fill_corners(blocks)
+        seconds['corners'] = scale * (time.time() - timer_start)
+    blocks_bytes = scale * empyrion.approximate_size(blocks)
+    if hollow_radius is not None:
+        timer_start = time.time()
+        blocks = hollow_pts(blocks, hollow_radius, None, frontier_morphology,
+                            bitset_morphology, True)
+        seconds['hollowing'] = scale * (time.time() - timer_start)
+    estimate['blocks'] = int(scale * len(blocks))
+
+    # Blueprint generation is dominated by the dense matrix, so its time is scaled
+    # by the number of cells rather than the surface area.
+    timer_start = time.time()
+    mapped_blocks = empyrion.map_to_empyrion_codes(blocks)
+    empyrion.generate_blocks([tuple(b[:3]) for b in mapped_blocks],
+                             [tuple(b[3:]) for b in mapped_blocks], False)
+    m, M = empyrion.bounding_box(blocks)
+    sample_cells = (M[0] - m[0] + 1) * (M[1] - m[1] + 1) * (M[2] - m[2] + 1)
+    seconds['generation'] = ((time.time() - timer_start) *
+                             estimate['dense_matrix_cells'] / sample_cells)
+
+    # The dense matrix is built once more for flood-fill hollowing.
+    dense_bytes = empyrion.dense_matrix_size(*dims)
+    if flood_hollow:
+        dense_bytes *= 2
+    blocks_bytes += dense_bytes
+    estimate['memory_bytes'] = int(max(read_bytes, mesh_bytes +
+                                       max(points_bytes, blocks_bytes)))
+    seconds['total'] = sum(seconds.values())
+    estimate['seconds'] = seconds
+
+    sys.stderr.write(
+        "Estimate from %.1f%% of the surface: %d points, %d blocks in a %s blueprint "
+        "(%d dense matrix cells), %.0f MB peak memory, and %.1f seconds in one "
+        "process.\n" % (100 * fraction, estimate['points'], estimate['blocks'],
+                        "x".join(str(d) for d in dims),
+                        estimate['dense_matrix_cells'],
+                        estimate['memory_bytes'] / 2.0 ** 20, seconds['total']))
+    sys.stderr.write("Estimation took %s seconds.\n" %
+                     str(time.time() - operation_start))
+    return base64.b64encode(json.dumps(estimate, indent=2, sort_keys=True))
+
+
+# The blueprint size of the probe used to estimate how many points the surface of a
+# model splits into, per square of the size.
+BUDGET_PROBE_SIZE = 24
+
+
+def fit_block_budget(event, budget):
+    """
+    Find the largest blueprint size at which the model fits in the given number of
+    blocks, and return the blueprint made at that size. Probes only split the model
+    and count the points, without closing, smoothing or building a blueprint. The
+    block count is taken to grow as the square of the size, as the surface does: a
+    probe at a small size gives the candidate size, which is made in full. The
+    ratio of blocks to the square of the size measured there gives the next
+    candidate, until a size fits and probes of it and the next size scale its block
+    count over the budget at the next size.
+    """
+    if event.get('Estimate', False) or event.get('OrientationSweep', False):
+        raise ValueError("A block budget cannot be combined with an estimate or an "
+                         "orientation sweep, which do not produce a blueprint.")
+
+    operation_start = time.time()
+    voxel_dimension = event.get('BlueprintSize', 25)
+    dim = voxel_dimension[0] if isinstance(voxel_dimension, list) else None
+    sized = lambda size: [dim, size] if dim is not None else size
+
+    # The probes read the model once, and are placed and reflected as in a full run.
+    triangles = empyrion.STLFile.read_triangles(
+        stl_file(base64.b64decode(event['STLBody'])))
+    mesh = None
+    if len(triangles) > 0 and event.get('Weld', False):
+        weld_tolerance = event.get('WeldTolerance', None)
+        if weld_tolerance is None:
+            weld_tolerance = empyrion.mesh_weld_tolerance(triangles)
+        mesh = empyrion.IndexedMesh.weld(triangles, weld_tolerance)[0]
+        triangles = mesh.triangles()
+    if len(triangles) == 0:
+        raise ValueError("The model produced no blocks, so cannot be fitted to a "
+                         "budget.")
+    bounds = empyrion.triangle_list_bounds(triangles)
+    place = empyrion.AxisTransform([-sum(b) / 2 for b in bounds]).triangles
+    reflect = event.get('Reflect', None)
+    decimate = event.get('Decimate', None)
+    probes = dict()
+
+    def probe(size):
+        if size not in probes:
+            resolution = model_resolution(bounds, sized(size))
+            tris = triangles
+            if decimate is not None:
+                if mesh is None:
+                    tris = empyrion.IndexedMesh.weld(triangles)[0]
+                else:
+                    tris = mesh
+                tris = tris.cluster(decimate * resolution)[0].triangles()
+            tris = place(tris)
+            if reflect is not None:
+                tris = tris + [tri.reflect(reflect) for tri in tris]
+            probes[size] = len(empyrion.split_tris(tris, resolution))
+            sys.stderr.write("Block budget search: size %d splits into %d points.\n" %
+                             (size, probes[size]))
+        return probes[size]
+
+    def run(size):
+        sized_event = dict(event)
+        del sized_event['BlockBudget']
+        sized_event['BlueprintSize'] = sized(size)
+        encoded = lambda_handler(sized_event, None)
+        n_blocks = 0
+        if encoded:
+            n_blocks = empyrion.Blueprint.decode(base64.b64decode(encoded)).n_blocks
+        sys.stderr.write("Block budget search: size %d gives %d blocks.\n" %
+                         (size, n_blocks))
+        if n_blocks == 0:
+            raise ValueError("The model produced no blocks, so cannot be fitted to a "
+                             "budget.")
+        return encoded, n_blocks
+
+    per_square = 1.0 * probe(BUDGET_PROBE_SIZE) / BUDGET_PROBE_SIZE ** 2
+    size = max(int(math.sqrt(budget / per_square)), 2)
+
+    # The largest size known to fit, with its blueprint, and the smallest size known
+    # to be over the budget.
+    fit = None
+    over = None
+    n_runs = 0
+    while True:
+        encoded, n_blocks = run(size)
+        n_runs += 1
+        if n_blocks <= budget:
+            fit = (size, encoded)
+            if over == size + 1:
+                break
+            if 1.0 * n_blocks * probe(size + 1) / probe(size) > budget:
+                over = size + 1
+                break
+        else:
+            over = size
+            if fit is None and size <= 2:
+                raise ValueError("Could not fit the model in %d blocks." % budget)
+            if fit is not None and over == fit[0] + 1:
+                break
+        per_square = 1.0 * n_blocks / size ** 2
+        size = int(math.sqrt(budget / per_square))
+        size = max(size, fit[0] + 1 if fit is not None else 2)
+        if over is not None:
+            size = min(size, over - 1)
+
+    sys.stderr.write("Block budget search chose size %d with %d full runs and %d "
+                     "probes, as size %d is over %d blocks, in %s seconds.\n" %
+                     (fit[0], n_runs, len(probes), over, budget,
+                      str(time.time() - operation_start)))
+    return fit[1]
+
+
+# The largest blueprint size used for orientation sweep previews, which only need to
+# be big enough to recognise the model.
+ORIENTATION_SWEEP_SIZE = 15
+
+
+def orientation_sweep(event):
+    """
+    Voxelize the model once at a coarse size, and try it in all 48 orientations that
+    the dimension remapping and mirroring options can give. Each orientation is a
+    transform of the voxels rather than of the model, so is cheap. Return a zip
+    archive with a cube-only preview blueprint for each orientation, and a summary
+    of the bounding box and the bottom face of each.
+    """
+    operation_start = time.time()
+    stl_body = base64.b64decode(event['STLBody'])
+    voxel_dimension = event.get('BlueprintSize', ORIENTATION_SWEEP_SIZE)
+    bp_class = event.get('BlueprintClass', 'SV')
+    block_type = event.get('BlockType', 'Steel-Small')
+    no_multithreading = event.get('NoMultithreading', False)
+
+    with open('BlueprintBase/BlueprintBase.epb', 'r') as fp:
+        bp_body = fp.read()
+
+    triangles = empyrion.STLFile.read_triangles(stl_file(stl_body))
+    if len(triangles) == 0:
+        return ""
+    bounds = empyrion.triangle_list_bounds(triangles)
+    if isinstance(voxel_dimension, list):
+        voxel_dimension = voxel_dimension[1]
+    size = min(abs(voxel_dimension), ORIENTATION_SWEEP_SIZE)
+    resolution = model_resolution(bounds, size)
+
+    timer_start = time.time()
+    origin_offset = [-sum(b) / 2 for b in bounds]
+    triangles = empyrion.AxisTransform(origin_offset).triangles(triangles)
+    if empyrion.parallel() and not no_multithreading:
+        pts = empyrion.parallel_split_tris(triangles, resolution)
+    else:
+        pts = empyrion.split_tris(triangles, resolution)
+    sys.stderr.write("Voxelized the model into %d points at size %d in %s seconds.\n" %
+                     (len(pts), size, str(time.time() - timer_start)))
+
+    sso = StringIO.StringIO()
+    zf = zipfile.ZipFile(sso, 'w', zipfile.ZIP_DEFLATED)
+    lines = ["remap  mirror  rotation  dimensions  aspect  base  base-fill  "
+             "centre-height"]
+    for dim_remap, dim_mirror in empyrion.AxisTransform.orientations():
+        transform = empyrion.AxisTransform.from_options(dim_remap, dim_mirror)
+        oriented_pts = transform.points(pts)
+        summary = empyrion.orientation_summary(oriented_pts)
+        remap = ",".join(str(d) for d in dim_remap)
+        mirror = ",".join(str(d) for d in dim_mirror) or "-"
+        lines.append("%-5s  %-6s  %-8s  %-10s  %6.2f  %4d  %9.2f  %13.2f" % (
+            remap, mirror, "yes" if transform.is_rotation() else "no",
+            "x".join(str(d) for d in summary['dims']), summary['aspect'],
+            summary['base'], summary['base_fill'], summary['centre_height']))
+
+        mapped_blocks = empyrion.map_to_empyrion_codes(dict.fromkeys(oriented_pts, 0))
+        new_bp = empyrion.build_new_bp(bp_body, mapped_blocks, bp_class, False,
+                                       block_type)
+        name = "remap-%s" % remap
+        if len(dim_mirror) > 0:
+            name += "-mirror-%s" % mirror
+        zf.writestr(name + ".epb", new_bp)
+
+    summary_text = "\n".join(lines) + "\n"
+    zf.writestr("summary.txt", summary_text)
+    zf.close()
+    sys.stderr.write(summary_text)
+    sys.stderr.write("Orientation sweep took %s seconds.\n" %
+                     str(time.time() - operation_start))
+    return base64.b64encode(sso.getvalue())
+
+
+def hollow_pts(smoothed_pts, hollow_radius, symmetric_dim, frontier_morphology,
+               bitset_morphology, no_multithreading):
+    """
+    Hollow out the blocks of the model, keeping only those within the hollow radius
+    of the exterior.
+    """
+    sys.stderr.write("Hollowing voxel cloud...\n")
+    timer_start = time.time()
+    if bitset_morphology:
+        hollow = empyrion.bitset_hollow
+    elif frontier_morphology and empyrion.parallel() and not no_multithreading:
+        hollow = empyrion.parallel_frontier_hollow
+    elif frontier_morphology:
+        hollow = empyrion.frontier_hollow
+    else:
+        hollow = empyrion.hollow
+    # The blocks are passed by reference, and only the passing coordinates are copied
+    passing_blocks = empyrion.symmetric_apply(
+        smoothed_pts, symmetric_dim, hollow_radius,
+        lambda q: hollow(q, hollow_radius))
+    # The passing blocks are all of the block coordinates we should keep
+    smoothed_pts = dict([(c, smoothed_pts[c]) for c in passing_blocks])
+    sys.stderr.write("Model hollowing took %s seconds.\n" %
+                     str(time.time() - timer_start))
+    sys.stderr.write("Hollowed down to %d blocks.\n" % len(smoothed_pts))
+    return smoothed_pts
+
+
+# The decimation check splits about this fraction of the triangles of the original
+# mesh, taken evenly through it, and looks this many blocks around their voxels for
+# the voxels of the decimated mesh.
+DECIMATION_CHECK_FRACTION = 0.05
+DECIMATION_CHECK_LIMIT = 3
+
+
+def verify_decimated_mesh(sample, pts, resolution):
+    """
+    Split a sample of the triangles of the original mesh, and check that every voxel
+    of the sample is within one block of the voxels split from the decimated mesh,
+    given as a collection or a SlabStore. This finds the features lost to collapsed
+    faces. The other way around needs no check: vertex clustering keeps every vertex
+    within its cell, so every face moves by at most the diagonal of a cell.
+    """
+    timer_start = time.time()
+    reference = empyrion.split_tris(sample, resolution)
+    if isinstance(pts, empyrion.SlabStore):
+        slabs = dict()
+        for p in reference:
+            slabs.setdefault(p[2] // pts.thickness, []).append(p)
+        lost = distance = 0
+        for slab, slab_reference in slabs.iteritems():
+            z0 = slab * pts.thickness
+            near = [r[:3] for r in pts.read_range(
+                z0 - DECIMATION_CHECK_LIMIT,
+                z0 + pts.thickness - 1 + DECIMATION_CHECK_LIMIT)]
+            slab_lost, slab_distance = empyrion.voxel_set_distance(
+                slab_reference, near, DECIMATION_CHECK_LIMIT)
+            lost += slab_lost
+            distance = max(distance, slab_distance)
+    else:
+        lost, distance = empyrion.voxel_set_distance(reference, pts,
+                                                     DECIMATION_CHECK_LIMIT)
+    sys.stderr.write("Decimation verification took %s seconds: %d of %d voxels of a "
+                     "sample of %d of the original triangles lost, and the largest "
+                     "distance to the decimated model is %d.\n" %
+                     (str(time.time() - timer_start), lost, len(reference),
+                      len(sample), distance))
+    if distance > 1:
+        raise ValueError("Decimation moved the surface of the model by more than a "
+                         "block; use a smaller --decimate fraction.")
+
+
+def verify_new_bp(new_bp):
+    """
+    Re-decode a newly built blueprint and raise an error if it is not self-consistent.
+    """
+    timer_start = time.time()
+    problems = empyrion.verify_bp(new_bp)
+    if len(problems) > 0:
+        raise ValueError("Generated blueprint failed verification: %s" %
+                         "; ".join(problems))
+    sys.stderr.write("Blueprint verification took %s seconds.\n" %
+                     str(time.time() - timer_start))
+
+
+def out_of_core_pipeline(triangles, bounds, resolution, bp_body, bp_class,
+                         morphological_factors, hollow_radius, disable_smoothing,
+                         aggressive_smoothing, corner_blocks, tile_budget, block_type,
+                         report_sections=False, decimation_sample=None):
+    """
+    Run the voxelization pipeline with the voxels spilled to disk in slabs, so that
+    the peak memory use is bounded by the tile budget (the number of cells in a slab
+    of the dense blueprint matrix) rather than the size of the model. Returns an
+    empty string if the model produces no blocks.
+    """
+    # Size the slabs so that the dense cross-section of each slab, including the
+    # margin that dilation and smoothing may add around the model, fits the budget.
+    margin = 3 + (morphological_factors[0] if morphological_factors is not None else 0)
+    extents = [int(round((b[1] - b[0]) / resolution)) + 1 + 2 * margin for b in bounds]
+    thickness = max(1, tile_budget // (extents[0] * extents[1]))
+    sys.stderr.write("Out-of-core slab thickness: %d blocks\n" % thickness)
+
+    stores = []
+    try:
+        sys.stderr.write("Splitting triangles...\n")
+        timer_start = time.time()
+        pts = empyrion.SlabStore(thickness)
+        stores.append(pts)
+        empyrion.out_of_core_split_tris(triangles, resolution, pts)
+        if decimation_sample is not None:
+            verify_decimated_mesh(decimation_sample, pts, resolution)
+        sys.stderr.write("Triangle to point refinement took %s seconds.\n" %
+                         str(time.time() - timer_start))
+        sys.stderr.write("Split %d triangles into %d points.\n" %
+                         (len(triangles), len(pts)))
+
+        if morphological_factors is not None:
+            sys.stderr.write("Closing voxel cloud...\n")
+            timer_start = time.time()
+            closed_pts = empyrion.SlabStore(thickness)
+            stores.append(closed_pts)
+            pts = empyrion.out_of_core_stage(
+                pts, closed_pts, sum(morphological_factors),
+                lambda recs: empyrion.morphological_erode(
+                    empyrion.morphological_dilate(recs, morphological_factors[0]),
+                    morphological_factors[1]))
+            sys.stderr.write("Morphological closing took %s seconds.\n" %
+                             str(time.time() - timer_start))
+            sys.stderr.write("Morphological closing produced %d points.\n" %
+                             len(pts))
+
+        # Smoothing and corner filling are carried from each slab into the next.
+        sys.stderr.write("Smoothing voxel cloud...\n")
+        timer_start = time.time()
+        blocks = empyrion.SlabStore(thickness, "<lllBB")
+        stores.append(blocks)
+        if not disable_smoothing:
+            empyrion.out_of_core_smooth(pts, blocks, aggressive_smoothing, corner_blocks)
+        else:
+            for slab in pts.slabs:
+                blocks.add([p + (0, 1) for p in pts.read(slab)])
+            blocks.compact()
+        sys.stderr.write("Voxel smoothing took %s seconds.\n" %
+                         str(time.time() - timer_start))
+        sys.stderr.write("Smoothed %d voxels into %d blocks.\n" %
+                         (len(pts), len(blocks)))
+
+        if hollow_radius is not None:
+            sys.stderr.write("Hollowing voxel cloud...\n")
+            timer_start = time.time()
+
+            def hollow(recs):
+                passing_blocks = set(empyrion.hollow([r[:3] for r in recs], hollow_radius))
+                return [r for r in recs if r[:3] in passing_blocks]
+
+            hollowed_blocks = empyrion.SlabStore(thickness, "<lllBB")
+            stores.append(hollowed_blocks)
+            blocks = empyrion.out_of_core_stage(blocks, hollowed_blocks,
+                                                hollow_radius, hollow)
+            sys.stderr.write("Model hollowing took %s seconds.\n" %
+                             str(time.time() - timer_start))
+            sys.stderr.write("Hollowed down to %d blocks.\n" % len(blocks))
+
+        if len(blocks) == 0:
+            return ""
+
+        timer_start = time.time()
+        new_bp = empyrion.out_of_core_build_new_bp(bp_body, blocks, bp_class,
+                                                   block_type, report_sections)
+        sys.stderr.write("Blueprint generation took %s seconds.\n" %
+                         str(time.time() - timer_start))
+    finally:
+        for store in stores:
+            store.close()
+
+    return new_bp
+
+
 def blueprint_size(v):
     """
     Parse a string as a blueprint size:
@@ -316,6 +1062,40 @@ def __main():
             resulting Blueprint resolution. If a value of the form '1,50' is
             given, then the model is chosen to have a size of 50 in the first
             dimension. Viable dimension indicators are 1, 2, or 3.""")
+        parser.add_argument(
+            "--block-budget",
+            required=False,
+            default=None,
+            type=int,
+            help="""The largest number of blocks the blueprint may have. If given, the
+            largest --blueprint-size that fits is searched for, using probes that
+            only split the model to estimate it, and --blueprint-size only chooses
+            the dimension measured.""")
+        parser.add_argument(
+            "--compress-output",
+            required=False,
+            default=None,
+            choices=['gzip', 'deflate'],
+            help="""Compress the output with gzip, or zlib (HTTP deflate). Compressed
+            STL files are always recognised and read, whatever their name.""")
+        parser.add_argument(
+            "--estimate",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Instead of a blueprint, write a JSON estimate of the point and block
+            counts, the blueprint dimensions, the peak memory and the time of each
+            stage, made by processing a sample of the model. It cannot be combined
+            with --solid-fill or --out-of-core.""")
+        parser.add_argument(
+            "--orientation-sweep",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Voxelize the model once at a small size (at most %d), and write a
+            zip archive of preview blueprints for all 48 combinations of
+            --dimension-remap and --dimension-mirror, with a summary of the size and
+            bottom face of each, instead of a blueprint.""" % ORIENTATION_SWEEP_SIZE)
         parser.add_argument(
             "--dimension-remap",
             required=False,
@@ -333,6 +1113,14 @@ def __main():
             required=False,
             default=None,
             help="The class (CV, HV, SV, BA) of the blueprint.")
+        parser.add_argument(
+            "--block-type",
+            required=False,
+            default='Steel-Small',
+            choices=sorted(empyrion.BLOCK_TYPE_CODES.keys()),
+            help="""The hull block to build the blueprint from. Defaults to small
+            steel blocks, which suit SV and HV blueprints. CV and BA blueprints can
+            use CombatSteel-Large.""")
         parser.add_argument(
             "--morphological-factors",
             required=False,
@@ -348,8 +1136,8 @@ def __main():
             type=int,
             help="""A positive integer value indicating how much hollowing to perform
             after the smoothing process. Best used in conjunction with morphological
-            smoothing to hollow out filled interiors. Larger values result in thicker
-            walls.""")
+            smoothing or --solid-fill to hollow out filled interiors. Larger values
+            result in thicker walls.""")
         parser.add_argument(
             "--flood-hollow",
             required=False,
@@ -387,6 +1175,120 @@ def __main():
             action='store_true',
             help="""Force the use fo single-threaded code and disabeles the use of
             multiprocessing modules even if they are available.""")
+        parser.add_argument(
+            "--weld",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Weld the vertices of the model into an indexed mesh, and remove
+            collapsed, zero-area and duplicate triangles, before splitting. Speeds
+            up models exported as triangle soup with many duplicate triangles.""")
+        parser.add_argument(
+            "--weld-tolerance",
+            required=False,
+            default=None,
+            type=float,
+            help="""The distance, in model units, within which vertices are welded
+            together with --weld. Defaults to a millionth of the diagonal of the
+            model.""")
+        parser.add_argument(
+            "--decimate",
+            required=False,
+            default=None,
+            type=float,
+            help="""Decimate the model before splitting, by merging the vertices in
+            each cell of a grid of the given fraction of a block (for example 0.5).
+            Greatly speeds up models with facets much smaller than a block.""")
+        parser.add_argument(
+            "--disable-decimation-check",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Disable splitting a sample of the original model, and failing if
+            any of its blocks is more than one block from the decimated model, which
+            is otherwise done whenever --decimate is given.""")
+        parser.add_argument(
+            "--solid-fill",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Fill the interior of the model by casting a ray through every
+            column of blocks and counting its crossings with the mesh. The mesh must
+            be closed. Much faster than filling with --morphological-factors, and
+            best used with --hollow-radius.""")
+        parser.add_argument(
+            "--bitset-morphology",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Perform morphological closing, hollowing and flood-fill hollowing
+            on whole columns of blocks at once, stored as integer bitmasks. Much
+            faster on both CPython and PyPy, and takes precedence over
+            --frontier-morphology.""")
+        parser.add_argument(
+            "--frontier-morphology",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Apply the morphological closing and hollowing brushes only at the
+            surface of the voxel cloud, and keep or drop the interior in bulk. The
+            result is the same, but is much faster for large solid models.""")
+        parser.add_argument(
+            "--symmetric",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""When used with --reflect, only the half of the model on one side of
+            the reflection plane is voxelized, smoothed, filled in with corner blocks and
+            hollowed, and the result is mirrored to produce the other half.""")
+        parser.add_argument(
+            "--tiled-splitting",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Bin the triangles into spatial tiles and split each tile in its own
+            process, so that every process returns a disjoint set of points. Reduces
+            the work done merging points for large models.""")
+        parser.add_argument(
+            "--tile-size",
+            required=False,
+            default=None,
+            type=int,
+            help="""The edge length, in blocks, of the tiles used by --tiled-splitting.
+            If not given, a size is chosen based on the model size and CPU count.""")
+        parser.add_argument(
+            "--closing-tile-size",
+            required=False,
+            default=None,
+            type=int,
+            help="""The edge length, in blocks, of the tiles that morphological
+            closing is performed in. Defaults to four times the sum of the closing
+            radii, and at least %d.""" % empyrion.CLOSING_TILE_SIZE)
+        parser.add_argument(
+            "--out-of-core",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Spill the voxel cloud to temporary files in slabs, and process one
+            slab at a time, for models too large to fit in memory. It cannot be combined
+            with --flood-hollow, --solid-fill, --symmetric, --frontier-morphology or
+            --bitset-morphology.""")
+        parser.add_argument(
+            "--tile-budget",
+            required=False,
+            default=2**24,
+            type=int,
+            help="""The number of blueprint cells to hold in memory per slab when using
+            --out-of-core. Smaller values use less memory, at the cost of more passes
+            over the temporary files.""")
+        parser.add_argument(
+            "--verify-blueprint",
+            required=False,
+            default=False,
+            action='store_true',
+            help="""Re-decode the resulting blueprint and fail if it is not
+            self-consistent, and report the raw and deflated size of each section of
+            its block data. To check existing blueprints, use verify_bp.py.""")
         parser.add_argument(
             "--version-check",
             required=False,
@@ -455,16 +1357,56 @@ def __main():
             'FloodHollow':
             pargs.flood_hollow,
             'NoMultithreading':
-            pargs.disable_multithreading
+            pargs.disable_multithreading,
+            'TiledSplitting':
+            pargs.tiled_splitting,
+            'TileSize':
+            pargs.tile_size,
+            'ClosingTileSize':
+            pargs.closing_tile_size,
+            'OutOfCore':
+            pargs.out_of_core,
+            'TileBudget':
+            pargs.tile_budget,
+            'VerifyBlueprint':
+            pargs.verify_blueprint,
+            'BlockType':
+            pargs.block_type,
+            'Symmetric':
+            pargs.symmetric,
+            'FrontierMorphology':
+            pargs.frontier_morphology,
+            'SolidFill':
+            pargs.solid_fill,
+            'BitsetMorphology':
+            pargs.bitset_morphology,
+            'Weld':
+            pargs.weld,
+            'WeldTolerance':
+            pargs.weld_tolerance,
+            'Decimate':
+            pargs.decimate,
+            'DisableDecimationCheck':
+            pargs.disable_decimation_check,
+            'BlockBudget':
+            pargs.block_budget,
+            'OrientationSweep':
+            pargs.orientation_sweep,
+            'Estimate':
+            pargs.estimate,
+            'ResponseCompression':
+            pargs.compress_output
         }
 
         flusher = StderrFlusher()
         flusher.start()
 
-        new_bp_64 = lambda_handler(lambda_body, None)
-
-        flusher.running = False
-        flusher.join()
+        try:
+            new_bp_64 = lambda_handler(lambda_body, None)
+        finally:
+            # The flusher would otherwise keep the process alive after an error.
+            flusher.running = False
+            flusher.join()
 
     if pargs is not None and pargs.blueprint_output_file is not None:
         with open(pargs.blueprint_output_file, 'wb') as fp:
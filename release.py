@@ -45,6 +45,7 @@ def __main():
     zfile.write("dist/lambda_index.exe", "lambda_index.exe")
     zfile.write("lambda_index.py")
     zfile.write("empyrion.py")
+    zfile.write("verify_bp.py")
     zfile.write("BlueprintBase/BlueprintBase.jpg")
     zfile.write("BlueprintBase/BlueprintBase.epb")
     zfile.writestr("git.json", git_md())
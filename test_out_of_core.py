@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Regression checks for out_of_core_smooth(), against smoothing the whole model in
+memory.
+
+Run from the repository root: python -m unittest test_out_of_core
+"""
+
+import unittest
+
+import empyrion
+
+
+class OutOfCoreSmoothTest(unittest.TestCase):
+
+    def setUp(self):
+        # A ball with a slanted slab cut out of it, to give slopes along every axis,
+        # conflicts between them and corners.
+        self.points = [
+            (x, y, z) for x in range(-7, 8) for y in range(-7, 8) for z in range(-7, 8)
+            if x * x + y * y + z * z <= 49 and not 0 <= x + 2 * z < 3
+        ]
+
+    def smooth(self, thickness, corners):
+        src = empyrion.SlabStore(thickness)
+        dst = empyrion.SlabStore(thickness, "<lllBB")
+        try:
+            src.add(self.points)
+            src.compact()
+            empyrion.out_of_core_smooth(src, dst, corners=corners)
+            return sorted([r for slab in dst.slabs for r in dst.read(slab)])
+        finally:
+            src.close()
+            dst.close()
+
+    def expected(self, corners):
+        blocks = empyrion.smooth_pts(self.points)
+        if corners:
+            blocks = empyrion.fill_corners(blocks)
+        return sorted(empyrion.map_to_empyrion_codes(blocks))
+
+    def test_smoothing(self):
+        for thickness in (1, 2, 5, 100):
+            self.assertEqual(self.smooth(thickness, False), self.expected(False))
+
+    def test_corners(self):
+        for thickness in (1, 2, 5, 100):
+            self.assertEqual(self.smooth(thickness, True), self.expected(True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Regression checks for verify_bp(), on blueprints with block records added or removed,
+and for decoding the blocks of a blueprint with Blueprint.voxels().
+
+Run from the repository root: python -m unittest test_verify_bp
+"""
+
+import struct
+import zipfile
+import unittest
+import StringIO
+
+import empyrion
+
+
+def blueprint(data, length, width, height):
+    """
+    Build a blueprint around the given block data, as build_new_bp() does.
+    """
+    with open('BlueprintBase/BlueprintBase.epb', 'rb') as fp:
+        bp_body = fp.read()
+    sso = StringIO.StringIO()
+    zf = zipfile.ZipFile(sso, 'w', zipfile.ZIP_DEFLATED)
+    zf.writestr('0', data)
+    zf.close()
+    return empyrion.assemble_bp(bp_body, sso, 'SV', length, width, height)
+
+
+class VerifyBlueprintTest(unittest.TestCase):
+
+    def setUp(self):
+        positions = [(x, y, z) for x in range(3) for y in range(2) for z in range(2)]
+        self.data, self.length, self.width, self.height = empyrion.generate_blocks(
+            positions, [(0, 1)] * len(positions), False)
+        n_hdr_bytes = struct.unpack("<L", self.data[:4])[0]
+        n_blocks = len(positions)
+        self.records_end = 4 + n_hdr_bytes + 4 * n_blocks
+
+    def verify(self, data):
+        return empyrion.verify_bp(blueprint(data, self.length, self.width,
+                                            self.height))
+
+    def test_valid(self):
+        self.assertEqual(self.verify(self.data), [])
+
+    def test_extra_record(self):
+        end = self.records_end
+        data = self.data[:end] + self.data[end - 4:end] + self.data[end:]
+        self.assertEqual(self.verify(data), ["12 block records expected, extra 4 bytes"])
+
+    def test_missing_record(self):
+        end = self.records_end
+        data = self.data[:end - 4] + self.data[end:]
+        self.assertEqual(self.verify(data),
+                         ["12 block records expected, missing 4 bytes"])
+
+    def test_bad_footer(self):
+        end = self.records_end
+        data = self.data[:end] + "\x00\x00" + self.data[end + 2:]
+        self.assertEqual(self.verify(data),
+                         ["Footer does not start with the section marker"])
+
+
+class BlueprintVoxelsTest(unittest.TestCase):
+
+    def setUp(self):
+        positions = [(x, y, z) for x in range(5) for y in range(3) for z in range(4)
+                     if (x + y + z) % 3 != 0]
+        shapes = sorted(set(empyrion.BLOCK_TYPE_MAPPING.values()))
+        rotations = sorted(empyrion.SLOPE_CODE_MAPPING.keys())
+        meta = [(shapes[i % len(shapes)], rotations[i % len(rotations)])
+                for i in range(len(positions))]
+        data, length, width, height = empyrion.generate_blocks(positions, meta, False)
+        self.bp = blueprint(data, length, width, height)
+        self.expected = sorted([p + m for p, m in zip(positions, meta)],
+                               key=empyrion.BLUEPRINT_ORDER)
+
+    def test_voxels(self):
+        # Chunks smaller than a block record are split across records.
+        for chunk_size in (3, 16, 1 << 20):
+            self.assertEqual(list(empyrion.Blueprint.voxels(self.bp, chunk_size)),
+                             self.expected)
+
+    def test_decode(self):
+        bp = empyrion.Blueprint.decode(self.bp, 5)
+        self.assertEqual(bp.n_blocks, len(self.expected))
+        self.assertEqual([p + (bp.block(i)[3], bp.block(i)[1])
+                          for i, p in enumerate(bp.positions())], self.expected)
+
+    def test_truncated(self):
+        data, length, width, height = empyrion.generate_blocks(
+            [(0, 0, 0), (1, 0, 0)], [(0, 1)] * 2, False)
+        n_hdr_bytes = struct.unpack("<L", data[:4])[0]
+        bp = blueprint(data[:4 + n_hdr_bytes + 4], length, width, height)
+        with self.assertRaises(ValueError):
+            list(empyrion.Blueprint.voxels(bp))
+
+
+if __name__ == "__main__":
+    unittest.main()
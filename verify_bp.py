@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Checks that blueprint (.epb) files are self-consistent, using as many processes as
+there are CPUs. Prints every problem found, and exits with a non-zero status if any
+blueprint fails.
+
+Example usage: python verify_bp.py Blueprints/*.epb
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+import empyrion
+
+
+def blueprint_files(paths):
+    """
+    Expand the given paths into the list of blueprint files, searching directories
+    recursively for .epb files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in sorted(names) if n.endswith(".epb")]
+        else:
+            files.append(path)
+    return files
+
+
+def __main():
+    parser = argparse.ArgumentParser(
+        description="""Checks that blueprint files are self-consistent, and exits with
+        a non-zero status if any are not.""")
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Blueprint files, or directories to search for .epb files.")
+    parser.add_argument(
+        "--disable-multithreading",
+        required=False,
+        default=False,
+        action='store_true',
+        help="Verify the blueprints one at a time in this process.")
+    pargs = parser.parse_args()
+
+    files = blueprint_files(pargs.paths)
+    if empyrion.shared_memory() and not pargs.disable_multithreading and len(files) > 1:
+        pool = multiprocessing.Pool()
+        results = pool.imap_unordered(empyrion.verify_bp_file, files, 16)
+    else:
+        pool = None
+        results = (empyrion.verify_bp_file(f) for f in files)
+
+    n_failed = 0
+    for filename, problems in results:
+        if len(problems) > 0:
+            n_failed += 1
+            for problem in problems:
+                sys.stdout.write("%s: %s\n" % (filename, problem))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write("%d of %d blueprints failed verification.\n" %
+                     (n_failed, len(files)))
+    if n_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    __main()